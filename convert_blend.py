@@ -1,13 +1,16 @@
 import argparse
 from dataclasses import dataclass
+import sys
 import yaml
+import django
 import os
 import shutil
-import requests
 import json
 from pathlib import Path
 from dotenv import load_dotenv
+from roboprop_client.conversion_pool import ConversionJob, convert
 from roboprop_client.export_model import export_sdf
+import roboprop_client.fileserver as fileserver
 
 load_dotenv()
 
@@ -18,34 +21,38 @@ def _send_request(endpoint, method, data=None, files=None):
     url = FILESERVER_URL + endpoint
     headers = {"X-DreamFactory-Api-Key": os.getenv("FILESERVER_API_KEY", "")}
     if method == "GET":
-        response = requests.get(url, headers=headers)
+        response = fileserver.request("GET", url, headers=headers)
     elif method == "PUT":
-        response = requests.put(url, data=json.dumps(data), headers=headers)
+        response = fileserver.request(
+            "PUT", url, data=json.dumps(data), headers=headers
+        )
     elif method == "POST":
-        response = requests.post(url, files=files, headers=headers, timeout=60)
+        # Stream the zip rather than reading it into memory
+        filename, file = files["files"]
+        body = fileserver.MultipartFileStream("files", filename, file)
+        headers["Content-Type"] = body.content_type
+        response = fileserver.request(
+            "POST", url, data=body, headers=headers, timeout=60
+        )
     return response  # type: ignore
 
 
 def _add_model_metadata(config):
-    endpoint = "files/index.json"
-    response = _send_request(endpoint, "GET")
-    if response.status_code == 200:
-        index = json.loads(response.content)
-        model_name = config.roboprop_key
-        model_metadata = config.metadata
-        model_metadata.update(
-            {
-                "source": "upload",
-                "scale": 1.0,
-                "url": FILESERVER_URL + f"files/models/{config.roboprop_key}/?zip=true",
-            }
-        )
-        index[model_name] = model_metadata
-        response = _send_request(endpoint, "PUT", index)
-        if response.status_code == 201:
-            return f"{model_name} uploaded to Roboprop and Metadata added successfully"
-        else:
-            return f"Error updating metadata for {model_name}: {response.content}"
+    # Through utils.update_index, so it takes the same index.json lock as the
+    # web app and Celery, and tells their catalogues about the change
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "roboprop.settings")
+    django.setup()
+    import roboprop_client.utils as utils
+
+    model_name = config.roboprop_key
+    try:
+        response = utils.update_index(model_name, config.metadata, "upload")
+    except TimeoutError as e:
+        return f"Error updating metadata for {model_name}: {e}"
+    if response.status_code in (200, 201):
+        return f"{model_name} uploaded to Roboprop and Metadata added successfully"
+    else:
+        return f"Error updating metadata for {model_name}: {response.content}"
 
 
 def _upload_model_to_roboprop(args, config):
@@ -75,17 +82,69 @@ class Config:
     @classmethod
     def from_yaml(cls, path: Path):
         with open(path) as f:
-            config = yaml.safe_load(f)
-            # validate config
-            assert config is not None, "roboprop.yaml is empty"
-            assert "roboprop_key" in config, "roboprop_key is missing in roboprop.yaml"
-            assert "blend_file" in config, "blend_file is missing in roboprop.yaml"
+            return cls.from_dict(yaml.safe_load(f))
+
+    @classmethod
+    def from_dict(cls, config):
+        # validate config
+        assert config is not None, "roboprop.yaml is empty"
+        assert "roboprop_key" in config, "roboprop_key is missing in roboprop.yaml"
+        assert "blend_file" in config, "blend_file is missing in roboprop.yaml"
+
+        return Config(
+            roboprop_key=config["roboprop_key"],
+            blend_file=config["blend_file"],
+            metadata=config.get("metadata", {}),
+        )
 
-            return Config(
-                roboprop_key=config["roboprop_key"],
-                blend_file=config["blend_file"],
-                metadata=config.get("metadata", {}),
-            )
+
+def _load_configs(path: Path):
+    """
+    Returns (config, directory blend_file is relative to) for a roboprop.yaml
+    file, every roboprop.yaml in a directory, or every entry in a manifest
+    """
+    if path.is_dir():
+        return [
+            (Config.from_yaml(roboprop_file), roboprop_file.parent)
+            for roboprop_file in sorted(path.rglob("roboprop.yaml"))
+        ]
+    with open(path) as f:
+        content = yaml.safe_load(f)
+    if not isinstance(content, list):
+        return [(Config.from_dict(content), path.parent)]
+    # A manifest lists paths to roboprop.yaml files, and/or configs inline
+    configs = []
+    for entry in content:
+        if isinstance(entry, str):
+            roboprop_file = path.parent / entry
+            configs.append((Config.from_yaml(roboprop_file), roboprop_file.parent))
+        else:
+            configs.append((Config.from_dict(entry), path.parent))
+    return configs
+
+
+def _convert_batch(args, configs_with_dirs):
+    configs = {config.roboprop_key: config for config, _ in configs_with_dirs}
+    jobs = [
+        ConversionJob(
+            blend_file=base_dir / config.blend_file,
+            out_dir=Path(args.out) / config.roboprop_key,
+            model_name=config.roboprop_key,
+            formats=args.formats,
+        )
+        for config, base_dir in configs_with_dirs
+    ]
+    failed = []
+    for result in convert(jobs, workers=args.workers, timeout=args.timeout):
+        if not result.ok:
+            print(f"Failed to convert {result.job.model_name}:\n{result.error}")
+            failed.append(result.job.model_name)
+            continue
+        print(f"Converted {result.job.model_name}")
+        if args.upload:
+            print(_upload_model_to_roboprop(args, configs[result.job.model_name]))
+    print(f"Converted {len(jobs) - len(failed)} of {len(jobs)} models")
+    return failed
 
 
 def main():
@@ -93,7 +152,9 @@ def main():
         description="Convert .blend file to model format using the roboprop.yaml config"
     )
     parser.add_argument(
-        "roboprop_file", type=str, help="Path to the roboprop.yaml file"
+        "roboprop_file",
+        type=str,
+        help="Path to the roboprop.yaml file, a directory of them or a manifest listing them",
     )
     parser.add_argument(
         "--out",
@@ -107,18 +168,43 @@ def main():
         default=False,
         help="Upload the result to RoboProp",
     )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        default=None,
+        help="Formats to export, e.g fbx glb. Defaults to all of them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of models converted in parallel. Defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=None,
+        help="Seconds after which a single conversion is abandoned",
+    )
 
     args = parser.parse_args()
     roboprop_file = Path(args.roboprop_file)
 
     # read roboprop.yaml
-    config = Config.from_yaml(roboprop_file)
+    configs = _load_configs(roboprop_file)
+    if len(configs) != 1 or roboprop_file.is_dir():
+        if _convert_batch(args, configs):
+            sys.exit(1)
+        return
+
+    config, base_dir = configs[0]
     print(f"Config:\n{config}")
 
     export_sdf(
         out_dir=Path(args.out) / config.roboprop_key,
         model_name=config.roboprop_key,
-        blend_file_path=roboprop_file.parent / config.blend_file,
+        blend_file_path=base_dir / config.blend_file,
+        formats=args.formats,
     )
 
     if args.upload:
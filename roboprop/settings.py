@@ -158,9 +158,20 @@ COMPRESS_ENABLED = True
 LOGIN_URL = "/login"
 
 SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+# How long (in seconds) a DreamFactory session is trusted before it's checked
+# again. Set to 0 to check it on every request.
+SESSION_VALIDATION_TTL = int(os.environ.get("SESSION_VALIDATION_TTL", 60))
 
-DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
+# Uploaded files larger than this are streamed to a temporary file (in
+# FILE_UPLOAD_TEMP_DIR) instead of being held in memory, and are then streamed
+# from there to the file server. There is no limit on the size of the file.
+DATA_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB, non-file form fields only
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB
+FILE_UPLOAD_TEMP_DIR = os.environ.get("FILE_UPLOAD_TEMP_DIR")
+
+# Resumable uploads are staged here until they are complete
+CHUNKED_UPLOAD_DIR = os.environ.get("CHUNKED_UPLOAD_DIR", BASE_DIR / "uploads")
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60  # Abandoned uploads are deleted after a day
 
 CELERY_RESULT_BACKEND = os.environ.get(
     "CELERY_BROKER_REDIS_URL", "redis://localhost:6379"
@@ -168,3 +179,36 @@ CELERY_RESULT_BACKEND = os.environ.get(
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_REDIS_URL", "redis://localhost:6379")
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers.DatabaseScheduler"
 CELERY_TASK_TIME_LIMIT = 10 * 60  # 10 minutes
+
+# Caching. Set CACHE_REDIS_URL (a Redis apart from Celery's) so that the web
+# and Celery containers share a cache, otherwise each process gets its own.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+if CACHE_REDIS_URL:
+    # A Redis of its own that evicts by LRU once full, see the cache service in
+    # docker-compose.yaml. Keeping it apart from Celery's Redis means cache
+    # pressure never evicts task results.
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+        },
+        "thumbnails": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+            "KEY_PREFIX": "thumbnails",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        "thumbnails": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "thumbnails",
+            # LocMemCache evicts the least recently used entries past this size
+            "OPTIONS": {
+                "MAX_ENTRIES": int(os.environ.get("THUMBNAIL_CACHE_SIZE", 500))
+            },
+        },
+    }
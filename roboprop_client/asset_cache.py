@@ -0,0 +1,80 @@
+import hashlib
+import uuid
+from django.core.cache import cache, caches
+
+# Thumbnails live in their own cache (see CACHES in settings.py) so that they
+# are evicted independently of search results and sessions.
+THUMBNAIL_CACHE = "thumbnails"
+THUMBNAIL_TIMEOUT = 24 * 60 * 60  # 1 day, uploads invalidate explicitly
+# Very large images would evict many small ones, so they are never cached
+THUMBNAIL_MAX_BYTES = 2 * 1024 * 1024
+# Uploads and imports invalidate the listing, the timeout only catches changes
+# made directly on the file server
+ASSET_LISTING_TIMEOUT = 5 * 60
+
+
+def _key(*parts):
+    # Asset names can contain spaces etc. which aren't valid in every backend
+    digest = hashlib.sha1("/".join(parts).encode("utf-8")).hexdigest()
+    return f"{parts[0]}:{digest}"
+
+
+def get_thumbnail_version(asset_type, asset_name):
+    # Every entry of an asset is keyed on its current version, so invalidating
+    # is a single write and stale entries are simply left to be evicted.
+    cache = caches[THUMBNAIL_CACHE]
+    version_key = _key("thumbnail-version", asset_type, asset_name)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+
+def _listing_key(asset_type, asset_name):
+    version = get_thumbnail_version(asset_type, asset_name)
+    return _key("thumbnail-listing", asset_type, asset_name, version)
+
+
+def _thumbnail_key(asset_type, asset_name, path):
+    version = get_thumbnail_version(asset_type, asset_name)
+    return _key("thumbnail", asset_type, asset_name, version, path)
+
+
+def get_thumbnail_listing(asset_type, asset_name):
+    return caches[THUMBNAIL_CACHE].get(_listing_key(asset_type, asset_name))
+
+
+def set_thumbnail_listing(asset_type, asset_name, paths):
+    caches[THUMBNAIL_CACHE].set(
+        _listing_key(asset_type, asset_name), paths, THUMBNAIL_TIMEOUT
+    )
+
+
+def get_thumbnail(asset_type, asset_name, path):
+    return caches[THUMBNAIL_CACHE].get(_thumbnail_key(asset_type, asset_name, path))
+
+
+def set_thumbnail(asset_type, asset_name, path, image):
+    if len(image["content"]) > THUMBNAIL_MAX_BYTES:
+        return
+    caches[THUMBNAIL_CACHE].set(
+        _thumbnail_key(asset_type, asset_name, path), image, THUMBNAIL_TIMEOUT
+    )
+
+
+def invalidate_thumbnails(asset_type, asset_name):
+    caches[THUMBNAIL_CACHE].delete(_key("thumbnail-version", asset_type, asset_name))
+
+
+def get_asset_listing(asset_type):
+    return cache.get(_key("asset-listing", asset_type))
+
+
+def set_asset_listing(asset_type, names):
+    cache.set(_key("asset-listing", asset_type), names, ASSET_LISTING_TIMEOUT)
+
+
+def invalidate_asset_listing(asset_type):
+    cache.delete(_key("asset-listing", asset_type))
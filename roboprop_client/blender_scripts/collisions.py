@@ -1,20 +1,252 @@
+import os
 import bpy
+import bmesh  # Only importable once bpy is
+import numpy as np
 
-def create_collision_model():
-# Collision model
+# "decomposition" approximates every object with a few convex parts, "hull" with
+# a single convex hull, and "mesh" simplifies the mesh itself. Convex shapes are
+# much cheaper to simulate in Gazebo than arbitrary meshes.
+COLLISION_MODE = os.getenv("COLLISION_MODE", "decomposition")
+# Triangles for the whole model, shared between objects by surface area
+COLLISION_TRIANGLE_BUDGET = int(os.getenv("COLLISION_TRIANGLE_BUDGET", 2000))
+MIN_OBJECT_TRIANGLES = 12  # A box
+MAX_OBJECT_TRIANGLES = 1000
+MAX_PARTS = 8
+# A part is only split if that removes at least this much of the volume of
+# the object's hull, so splitting stops once what is left is roughly convex
+MIN_SPLIT_GAIN = 0.02
+# Points sampled from each object's surface, on top of its vertices
+SURFACE_SAMPLES = 4000
+MAX_POINTS = 20000
+# Directions the hull of every part is sampled in while decomposing
+SPLIT_DIRECTIONS = 64
+# Where parts may be cut, along each axis
+SPLIT_QUANTILES = [0.25, 0.5, 0.75]
+# Points this close to a cut (relative to the part's size) go to both halves,
+# so there are no gaps between neighbouring parts
+SPLIT_OVERLAP = 0.02
+
+
+def _mesh_arrays(obj):
+    # Vertices and triangles with modifiers and shape keys applied, in the
+    # object's own space
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+        vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+        mesh.vertices.foreach_get("co", vertices)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+    finally:
+        evaluated.to_mesh_clear()
+    return vertices.reshape(-1, 3), triangles.reshape(-1, 3)
+
+
+def _surface_area(vertices, triangles, matrix=None):
+    if matrix is not None:
+        matrix = np.array(matrix)
+        vertices = vertices @ matrix[:3, :3].T + matrix[:3, 3]
+    corners = vertices[triangles]
+    edges = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    return np.linalg.norm(edges, axis=1) / 2
+
+
+def _sample_points(vertices, triangles, rng):
+    # The vertices alone leave long flat faces empty, which decomposition
+    # needs points on to know where to cut
+    areas = _surface_area(vertices, triangles)
+    points = [vertices]
+    if areas.sum() > 0:
+        chosen = rng.choice(len(triangles), SURFACE_SAMPLES, p=areas / areas.sum())
+        corners = vertices[triangles[chosen]]
+        # Uniform barycentric coordinates
+        u, v = rng.random((2, SURFACE_SAMPLES))
+        flip = u + v > 1
+        u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+        points.append(
+            corners[:, 0]
+            + u[:, None] * (corners[:, 1] - corners[:, 0])
+            + v[:, None] * (corners[:, 2] - corners[:, 0])
+        )
+    points = np.concatenate(points)
+    if len(points) > MAX_POINTS:
+        points = points[rng.choice(len(points), MAX_POINTS, replace=False)]
+    return points
+
+
+def _directions(count):
+    # Evenly spread over the sphere (a Fibonacci lattice)
+    i = np.arange(count) + 0.5
+    phi = np.arccos(1 - 2 * i / count)
+    theta = np.pi * (1 + 5**0.5) * i
+    return np.stack(
+        [np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)],
+        axis=1,
+    )
+
+
+def _extreme_points(points, directions):
+    # The hull of the points furthest out in n directions has at most 2n - 4
+    # triangles, which is what keeps every hull within its budget
+    return points[np.unique(np.argmax(points @ directions.T, axis=0))]
+
+
+def _convex_hull(points):
+    bm = bmesh.new()
+    for point in points:
+        bm.verts.new(point)
+    result = bmesh.ops.convex_hull(bm, input=bm.verts)
+    unused = set(result["geom_interior"]) | set(result["geom_unused"])
+    bmesh.ops.delete(bm, geom=list(unused), context="VERTS")
+    return bm
+
+
+def _hull_volume(points):
+    if len(points) < 4:
+        return 0.0
+    bm = _convex_hull(_extreme_points(points, _directions(SPLIT_DIRECTIONS)))
+    try:
+        return bm.calc_volume()
+    finally:
+        bm.free()
+
+
+class _Part:
+    def __init__(self, points):
+        self.points = points
+        self.volume = _hull_volume(points)
+        self._split = None
+
+    def split(self):
+        # Tries cuts across each of the principal axes, and keeps the one that
+        # leaves the least empty space in the hulls of the two halves
+        if self._split is None:
+            self._split = (0.0, None)
+            centered = self.points - self.points.mean(axis=0)
+            _, axes = np.linalg.eigh(centered.T @ centered)
+            for axis in axes.T:
+                distance = centered @ axis
+                overlap = SPLIT_OVERLAP * np.ptp(distance)
+                for cut in np.quantile(distance, SPLIT_QUANTILES):
+                    halves = [
+                        self.points[distance > cut - overlap],
+                        self.points[distance < cut + overlap],
+                    ]
+                    if min(len(half) for half in halves) < 4:
+                        continue
+                    halves = [_Part(half) for half in halves]
+                    gain = self.volume - sum(half.volume for half in halves)
+                    if gain > self._split[0]:
+                        self._split = (gain, halves)
+        return self._split
+
+
+def _decompose(points, max_parts):
+    parts = [_Part(points)]
+    total_volume = parts[0].volume
+    while len(parts) < max_parts:
+        part = max(parts, key=lambda part: part.split()[0])
+        gain, halves = part.split()
+        if halves is None or gain < MIN_SPLIT_GAIN * total_volume:
+            break
+        parts.remove(part)
+        parts.extend(halves)
+    return [part.points for part in parts]
+
+
+def _replace_mesh(obj, vertices, triangles):
+    mesh = bpy.data.meshes.new(f"{obj.data.name}_collision")
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", vertices.astype(np.float32).ravel())
+    mesh.loops.add(triangles.size)
+    mesh.loops.foreach_set("vertex_index", triangles.astype(np.int32).ravel())
+    mesh.polygons.add(len(triangles))
+    mesh.polygons.foreach_set(
+        "loop_start", np.arange(0, triangles.size, 3, dtype=np.int32)
+    )
+    mesh.update()
+    # Modifiers and shape keys are already applied to the new mesh
+    obj.modifiers.clear()
+    obj.data = mesh
+
+
+def _set_hulls(obj, parts, triangle_budget, triangle_count):
+    # No hull needs more triangles than the object had to begin with
+    hull_budget = min(triangle_budget // len(parts), triangle_count)
+    directions = _directions(max(4, hull_budget // 2 + 2))
+    vertices, triangles = [], []
+    offset = 0
+    for points in parts:
+        bm = _convex_hull(_extreme_points(points, directions))
+        bm.verts.index_update()
+        vertices.append(np.array([vert.co for vert in bm.verts]))
+        triangles.append(
+            np.array([[vert.index for vert in face.verts] for face in bm.faces])
+            + offset
+        )
+        offset += len(bm.verts)
+        bm.free()
+    _replace_mesh(obj, np.concatenate(vertices), np.concatenate(triangles))
+
+
+def _set_decimated(obj, vertices, triangles, triangle_budget):
+    _replace_mesh(obj, vertices, triangles)
+    if len(triangles) <= triangle_budget:
+        return
+    decimate_modifier = obj.modifiers.new("DecimateMod", "DECIMATE")
+    decimate_modifier.ratio = triangle_budget / len(triangles)  # Lower is simpler
+    bpy.context.view_layer.objects.active = obj
+    obj.select_set(True)
+    bpy.ops.object.modifier_apply(modifier=decimate_modifier.name)
+
+
+def _triangle_budgets(areas, triangle_budget):
+    # Larger objects get more of the budget, but no object gets fewer
+    # triangles than a box
+    areas = np.array(areas, dtype=np.float64)
+    shares = areas / areas.sum() if areas.sum() > 0 else np.ones(len(areas))
+    budgets = np.clip(
+        shares * triangle_budget, MIN_OBJECT_TRIANGLES, MAX_OBJECT_TRIANGLES
+    )
+    return budgets.astype(int)
+
+
+def create_collision_model(mode=None, triangle_budget=None):
+    mode = mode or COLLISION_MODE
+    triangle_budget = triangle_budget or COLLISION_TRIANGLE_BUDGET
+    if mode not in ["decomposition", "hull", "mesh"]:
+        raise ValueError(f"Unknown collision mode: {mode}")
+    rng = np.random.default_rng(0)  # The same model always gets the same result
+
+    objects, meshes, areas = [], [], []
     for obj in bpy.context.scene.objects:
-        if obj.type == "MESH":
-            obj.data = obj.data.copy() # Make the mesh single user
-            obj.shape_key_clear()  # Remove shape keys
-            # Decimate modifier
-            decimate_modifier = obj.modifiers.new("DecimateMod", "DECIMATE")
-            decimate_modifier.ratio = 0.5  # Lower is simpler
-            bpy.context.view_layer.objects.active = obj
-            obj.select_set(True)
-            bpy.ops.object.modifier_apply(modifier=decimate_modifier.name)
-
-            # Remesh modifier
-            remesh_modifier = obj.modifiers.new("RemeshMod", "REMESH")
-            remesh_modifier.mode = "SMOOTH"  # BLOCKS, SMOOTH, or SHARP
-            remesh_modifier.octree_depth = 6  # Lower is simpler
-            bpy.ops.object.modifier_apply(modifier=remesh_modifier.name)
+        if obj.type != "MESH":
+            continue
+        vertices, triangles = _mesh_arrays(obj)
+        if len(triangles) == 0:
+            continue
+        objects.append(obj)
+        meshes.append((vertices, triangles))
+        areas.append(_surface_area(vertices, triangles, obj.matrix_world).sum())
+    if not objects:
+        return
+    budgets = _triangle_budgets(areas, triangle_budget)
+
+    for obj, (vertices, triangles), budget in zip(objects, meshes, budgets):
+        if mode == "mesh":
+            _set_decimated(obj, vertices, triangles, budget)
+            continue
+        points = _sample_points(vertices, triangles, rng)
+        # Flat objects have no volume to wrap a hull around
+        if np.linalg.matrix_rank(points - points.mean(axis=0)) < 3:
+            _set_decimated(obj, vertices, triangles, budget)
+            continue
+        if mode == "decomposition":
+            # Low poly objects need as many parts as any other, e.g a table
+            # made of a few boxes, MIN_SPLIT_GAIN decides how many they get
+            parts = _decompose(points, min(MAX_PARTS, budget // MIN_OBJECT_TRIANGLES))
+        else:
+            parts = [points]
+        _set_hulls(obj, parts, budget, len(triangles))
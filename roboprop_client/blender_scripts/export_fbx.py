@@ -1,16 +1,8 @@
 import bpy
-from .collisions import create_collision_model
 from pathlib import Path
 
 
-def export_fbx(blend_file: Path, output: Path, collision_output: Path):
-    # Visual model
-    # Reset the state of Blender
-    bpy.ops.wm.read_factory_settings(use_empty=True)
-    # Load the blend file
-    bpy.ops.wm.open_mainfile(filepath=str(blend_file))
-    # Move texture images to external files so the exporter can copy them next to the model
-    bpy.ops.file.unpack_all(method="USE_LOCAL")
+def export_fbx_visual(output: Path):
     # Export FBX
     # https://docs.blender.org/api/current/bpy.ops.export_scene.html#module-bpy.ops.export_scene
     bpy.ops.export_scene.fbx(
@@ -22,7 +14,8 @@ def export_fbx(blend_file: Path, output: Path, collision_output: Path):
         apply_scale_options="FBX_SCALE_ALL",
     )
 
-    create_collision_model()
+
+def export_fbx_collision(collision_output: Path):
     # Export the collision model
     bpy.ops.export_scene.fbx(
         filepath=str(collision_output),
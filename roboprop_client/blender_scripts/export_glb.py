@@ -1,50 +1,137 @@
+import json
+import os
+import shutil
+import struct
+import subprocess
+import time
 import bpy
-from .collisions import create_collision_model
 from pathlib import Path
 
+# JPEG, WEBP (smaller, but not every glTF viewer can read it) or AUTO, which
+# keeps PNGs lossless
+GLTF_IMAGE_FORMAT = os.getenv("GLTF_IMAGE_FORMAT", "JPEG")
+GLTF_IMAGE_QUALITY = int(os.getenv("GLTF_IMAGE_QUALITY", 60))
+# Geometry compression for GLBs: "draco" needs Blender's Draco library (see
+# BLENDER_EXTERN_DRACO_LIBRARY_PATH), "meshopt" needs gltfpack. Not every
+# viewer can decode either, so it's off by default.
+GLTF_COMPRESSION = os.getenv("GLTF_COMPRESSION") or None
+GLTFPACK = os.getenv("GLTFPACK", "gltfpack")
+COMPRESSION_EXTENSIONS = {
+    "draco": "KHR_draco_mesh_compression",
+    "meshopt": "EXT_meshopt_compression",
+}
 
-def _export(blend_file: Path, output: Path, format: str, collision_output: Path):
-    # Reset the state of Blender
+
+def _compression_available(compression):
+    if compression == "meshopt":
+        return shutil.which(GLTFPACK) is not None
+    try:
+        from io_scene_gltf2.io.com.gltf2_io_draco_compression_extension import (
+            dll_exists,
+        )
+    except ImportError:
+        return False
+    return dll_exists(quiet=True)
+
+
+def _get_compression(compression):
+    if compression is None:
+        return None
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if not _compression_available(compression):
+        print(f"WARNING: {compression} compression isn't available, not compressing")
+        return None
+    return compression
+
+
+def _meshopt_compress(output: Path):
+    compressed = output.with_name(f"{output.stem}.meshopt{output.suffix}")
+    # -c compresses the geometry, -kn -km -ke keep the nodes, materials and
+    # extras as they were exported
+    subprocess.run(
+        [GLTFPACK, "-i", str(output), "-o", str(compressed), "-c", "-kn", "-km", "-ke"],
+        check=True,
+        capture_output=True,
+    )
+    os.replace(compressed, output)
+
+
+def get_glb_compression(path: Path):
+    # Read from the file itself, rather than trusting what was asked for
+    with open(path, "rb") as f:
+        f.seek(12)
+        json_length, _ = struct.unpack("<II", f.read(8))
+        extensions = json.loads(f.read(json_length)).get("extensionsUsed", [])
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if extension in extensions:
+            return compression
+    return None
+
+
+def measure_decode_time(path: Path):
+    # Imports the file into an empty scene, which includes decompressing its
+    # geometry. Only call this once everything has been exported.
     bpy.ops.wm.read_factory_settings(use_empty=True)
-    # Load the blend file
-    bpy.ops.wm.open_mainfile(filepath=str(blend_file))
-    if format == "GLTF_SEPARATE":
-        # Move texture images to external files so the exporter can copy them next to the model
-        bpy.ops.file.unpack_all(method="USE_LOCAL")
-    # Export GLB
+    start = time.perf_counter()
+    try:
+        bpy.ops.import_scene.gltf(filepath=str(path))
+    except RuntimeError:
+        # e.g Blender can't decode meshopt
+        return None
+    return time.perf_counter() - start
+
+
+def _export(output: Path, format: str, compression=None):
+    compression = _get_compression(compression)
     bpy.ops.export_scene.gltf(
         filepath=str(output),
         check_existing=False,
         use_selection=False,
         export_materials="EXPORT",
         export_format=format,
-        export_image_format="JPEG",
-        export_jpeg_quality=60,
+        export_image_format=GLTF_IMAGE_FORMAT,
+        export_jpeg_quality=GLTF_IMAGE_QUALITY,
+        export_image_quality=GLTF_IMAGE_QUALITY,
+        export_draco_mesh_compression_enable=compression == "draco",
         export_extras=True,
         # the export rigged models in pos, export_def_bones=True and export_rest_position_armature=False are needed
         export_rest_position_armature=False,
         # export_hierarchy_flatten_bones=True,
         export_def_bones=True,
     )
+    if compression == "meshopt":
+        _meshopt_compress(output)
 
-    create_collision_model()
-    # Export the collision model
+
+def _export_collision(collision_output: Path, format: str, compression=None):
+    compression = _get_compression(compression)
     bpy.ops.export_scene.gltf(
         filepath=str(collision_output),
         check_existing=False,
         use_selection=False,
-        export_materials="EXPORT",
+        # Only the shape matters for collisions
+        export_materials="NONE",
         export_format=format,
-        export_image_format="JPEG",
-        export_jpeg_quality=60,
+        export_draco_mesh_compression_enable=compression == "draco",
         export_extras=True,
         export_def_bones=True,
     )
+    if compression == "meshopt":
+        _meshopt_compress(collision_output)
+
+
+def export_glb_visual(output: Path, compression=None):
+    _export(output, "GLB", compression)
+
+
+def export_glb_collision(collision_output: Path, compression=None):
+    _export_collision(collision_output, "GLB", compression)
 
 
-def export_glb(blend_file: Path, output: Path, collision_output: Path):
-    _export(blend_file, output, "GLB", collision_output)
+def export_gltf_visual(output: Path):
+    _export(output, "GLTF_SEPARATE")
 
 
-def export_gltf(blend_file: Path, output: Path, collision_output: Path):
-    _export(blend_file, output, "GLTF_SEPARATE", collision_output)
+def export_gltf_collision(collision_output: Path):
+    _export_collision(collision_output, "GLTF_SEPARATE")
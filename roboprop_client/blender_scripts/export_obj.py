@@ -1,15 +1,8 @@
 import bpy
-from .collisions import create_collision_model
 from pathlib import Path
 
 
-def export_obj(blend_file: Path, output: Path, collision_output: Path):
-    # Reset the state of Blender
-    bpy.ops.wm.read_factory_settings(use_empty=True)
-    # Load the blend file
-    bpy.ops.wm.open_mainfile(filepath=str(blend_file))
-    # Move texture images to external files so the exporter can copy them next to the model
-    bpy.ops.file.unpack_all(method="USE_LOCAL")
+def export_obj_visual(output: Path):
     # Export OBJ
     bpy.ops.wm.obj_export(
         filepath=str(output),
@@ -26,16 +19,15 @@ def export_obj(blend_file: Path, output: Path, collision_output: Path):
         export_object_groups=True,
         export_material_groups=True,
     )
-    
-    create_collision_model()
-    # Export the collision model
-    bpy.ops.export_scene.obj(
+
+
+def export_obj_collision(collision_output: Path):
+    # Export the collision model. (bpy.ops.export_scene.obj is gone since Blender 4.0)
+    bpy.ops.wm.obj_export(
         filepath=str(collision_output),
         check_existing=False,
-        use_selection=False,
-        use_mesh_modifiers=True,
-        use_triangles=True,  # Convert all geometry to triangles
-        path_mode="COPY",
-        use_materials=False,
-)
-
+        export_selected_objects=False,
+        apply_modifiers=True,
+        export_triangulated_mesh=True,  # Convert all geometry to triangles
+        export_materials=False,
+    )
@@ -0,0 +1,43 @@
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+import bpy
+
+
+def _unpack_images(textures_dir: Path):
+    # Packed textures are written to a folder of our own, rather than next to
+    # the (possibly shared) original, so the exporters can copy them next to
+    # the model
+    textures_dir.mkdir(exist_ok=True)
+    for image in bpy.data.images:
+        if image.packed_file is None:
+            continue
+        name = bpy.path.basename(image.filepath) or (
+            f"{bpy.path.clean_name(image.name)}.{image.file_format.lower()}"
+        )
+        path = textures_dir / name
+        index = 1
+        while path.exists():
+            path = textures_dir / f"{Path(name).stem}_{index}{Path(name).suffix}"
+            index += 1
+        path.write_bytes(image.packed_file.data)
+        image.unpack(method="REMOVE")
+        image.filepath = str(path)
+
+
+@contextmanager
+def open_scene(blend_file: Path):
+    # Loads the blend file once, for every format to be exported from. Yields
+    # a temporary folder for files derived from it, e.g textures.
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Reset the state of Blender
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        # Load the blend file. Opened in place, as external textures are
+        # usually relative to it (//textures/...)
+        bpy.ops.wm.open_mainfile(filepath=str(blend_file))
+        _unpack_images(Path(work_dir) / "textures")
+        try:
+            yield Path(work_dir)
+        finally:
+            # Let go of the textures before work_dir is removed
+            bpy.ops.wm.read_factory_settings(use_empty=True)
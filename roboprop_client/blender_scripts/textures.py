@@ -0,0 +1,55 @@
+import hashlib
+import os
+from pathlib import Path
+import bpy
+
+# Textures larger than this on either side are scaled down, keeping their
+# aspect ratio. Gazebo loads every texture into memory at full size.
+TEXTURE_MAX_SIZE = int(os.getenv("TEXTURE_MAX_SIZE", 2048))
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def _file_sha256(path: Path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _downscale(image, textures_dir: Path, digest: str, max_size: int):
+    width, height = image.size
+    if max(width, height) <= max_size:
+        return
+    scale = max_size / max(width, height)
+    image.scale(max(1, round(width * scale)), max(1, round(height * scale)))
+    # Saved as a new file, the original may be outside of textures_dir
+    path = Path(bpy.path.abspath(image.filepath))
+    image.filepath_raw = str(textures_dir / f"{path.stem}_{digest[:8]}{path.suffix}")
+    image.save()
+
+
+def optimize_textures(work_dir: Path, max_size=None):
+    """
+    Merges identical images and scales down large ones in the loaded scene,
+    before anything is exported, so every format gets the same, smaller images
+    """
+    max_size = max_size or TEXTURE_MAX_SIZE
+    textures_dir = work_dir / "textures"
+    textures_dir.mkdir(exist_ok=True)
+    images = {}
+    for image in list(bpy.data.images):
+        if image.source != "FILE" or image.packed_file is not None:
+            continue
+        path = Path(bpy.path.abspath(image.filepath))
+        if not path.is_file():
+            continue
+        digest = _file_sha256(path)
+        # The same file can be used as e.g both color and non-color data
+        key = (digest, image.colorspace_settings.name, image.alpha_mode)
+        if key in images:
+            image.user_remap(images[key])
+            bpy.data.images.remove(image)
+            continue
+        images[key] = image
+        _downscale(image, textures_dir, digest, max_size)
@@ -0,0 +1,227 @@
+import heapq
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from django.core.cache import cache
+
+# An in-process search index over index.json. Each process keeps its own copy,
+# and rebuilds it whenever the version shared through the Django cache changes,
+# i.e whenever another process has updated index.json.
+CATALOGUE_VERSION_KEY = "catalogue_version"
+# index.json can also be changed without the version changing, e.g directly on
+# the file server, so each copy is rebuilt at least this often (in seconds)
+CATALOGUE_MAX_AGE = int(os.getenv("CATALOGUE_MAX_AGE", 5 * 60))
+FACETS = {
+    "tag": "tags",
+    "category": "categories",
+    "color": "colors",
+    "source": "source",
+}
+# A match in the name counts for more than one in the description
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+# Splits "KitchenSink_2 large" into "kitchen", "sink", "2" and "large"
+TOKEN_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+")
+
+
+def tokenize(text):
+    if not isinstance(text, str):
+        return []
+    return [token.lower() for token in TOKEN_PATTERN.findall(text)]
+
+
+def _facet_values(metadata, field):
+    values = metadata.get(field) or []
+    if isinstance(values, str):
+        values = [values]
+    return {value.strip().lower() for value in values if isinstance(value, str)}
+
+
+class Catalogue:
+    def __init__(self, index):
+        self.models = {}
+        # token -> {model name: weight}
+        self.postings = defaultdict(dict)
+        # facet -> value -> model names
+        self.facets = {facet: defaultdict(set) for facet in FACETS}
+        self._terms = None
+        for name, metadata in index.items():
+            self.upsert(name, metadata)
+
+    def upsert(self, name, metadata):
+        self.delete(name)
+        self.models[name] = metadata
+        weights = Counter()
+        for token in tokenize(name):
+            weights[token] += NAME_WEIGHT
+        for token in tokenize(metadata.get("description")):
+            weights[token] += DESCRIPTION_WEIGHT
+        for token, weight in weights.items():
+            self.postings[token][name] = weight
+        for facet, field in FACETS.items():
+            for value in _facet_values(metadata, field):
+                self.facets[facet][value].add(name)
+        self._terms = None
+
+    def delete(self, name):
+        metadata = self.models.pop(name, None)
+        if metadata is None:
+            return
+        for token in set(tokenize(name) + tokenize(metadata.get("description"))):
+            self.postings[token].pop(name, None)
+            if not self.postings[token]:
+                del self.postings[token]
+        for facet, field in FACETS.items():
+            for value in _facet_values(metadata, field):
+                self.facets[facet][value].discard(name)
+                if not self.facets[facet][value]:
+                    del self.facets[facet][value]
+        self._terms = None
+
+    def _matching_terms(self, prefix):
+        # Every query word also matches longer words, so "chai" finds "chair"
+        if self._terms is None:
+            self._terms = sorted(self.postings)
+        start = bisect_left(self._terms, prefix)
+        for term in self._terms[start:]:
+            if not term.startswith(prefix):
+                break
+            yield term
+
+    def search(self, query="", filters=None, offset=0, limit=20):
+        # Facet filters are combined with AND, both between and within facets
+        candidates = None
+        for facet, values in (filters or {}).items():
+            for value in values:
+                names = self.facets[facet].get(value.strip().lower(), set())
+                candidates = names if candidates is None else candidates & names
+
+        scores = None
+        for token in set(tokenize(query)):
+            token_scores = defaultdict(float)
+            for term in self._matching_terms(token):
+                postings = self.postings[term]
+                # Rarer words are worth more (idf)
+                idf = math.log(1 + len(self.models) / len(postings))
+                # Partial word matches count for less than whole ones
+                exact = 1.0 if term == token else 0.5
+                for name, weight in postings.items():
+                    token_scores[name] += weight * idf * exact
+            if scores is None:
+                scores = token_scores
+            else:
+                # Every word of the query has to match
+                scores = {
+                    name: score + token_scores[name]
+                    for name, score in scores.items()
+                    if name in token_scores
+                }
+
+        if scores is None:
+            names = self.models if candidates is None else candidates
+            scores = dict.fromkeys(names, 0.0)
+        elif candidates is not None:
+            scores = {
+                name: score for name, score in scores.items() if name in candidates
+            }
+
+        # Only the requested page needs to be put in order
+        ranked = heapq.nsmallest(
+            offset + limit, scores, key=lambda name: (-scores[name], name.lower())
+        )
+        matches = scores.keys()
+        facet_counts = {}
+        for facet, values in self.facets.items():
+            counts = Counter()
+            for value, names in values.items():
+                count = len(names & matches)
+                if count:
+                    counts[value] = count
+            facet_counts[facet] = counts
+
+        return {
+            "total": len(scores),
+            "results": [
+                {"name": name, "score": round(scores[name], 3), **self.models[name]}
+                for name in ranked[offset : offset + limit]
+            ],
+            "facets": {
+                facet: counts.most_common() for facet, counts in facet_counts.items()
+            },
+        }
+
+
+_lock = threading.RLock()
+# Held while index.json is fetched, so only one request per process fetches it
+_load_lock = threading.Lock()
+_catalogue = None
+_catalogue_version = None
+_catalogue_loaded_at = None
+
+
+def _is_current(version):
+    return (
+        _catalogue is not None
+        and version is not None
+        and version == _catalogue_version
+        and time.monotonic() - _catalogue_loaded_at < CATALOGUE_MAX_AGE
+    )
+
+
+def get_catalogue(load_index):
+    global _catalogue, _catalogue_version, _catalogue_loaded_at
+    version = cache.get(CATALOGUE_VERSION_KEY)
+    with _lock:
+        if _is_current(version):
+            return _catalogue
+    # Fetched without holding _lock, so searches aren't held up by a slow file
+    # server. While another request fetches it, the outdated catalogue is used.
+    if not _load_lock.acquire(blocking=_catalogue is None):
+        return _catalogue
+    try:
+        with _lock:
+            # Loaded by someone else while waiting for _load_lock
+            if _is_current(version):
+                return _catalogue
+        index = load_index()
+        with _lock:
+            if index is None:
+                # Better a slightly outdated catalogue than none at all
+                if _catalogue is None:
+                    raise ValueError("Failed to fetch index.json")
+                return _catalogue
+            if version is None:
+                version = uuid.uuid4().hex
+                cache.set(CATALOGUE_VERSION_KEY, version, None)
+            _catalogue = Catalogue(index)
+            _catalogue_version = version
+            _catalogue_loaded_at = time.monotonic()
+            return _catalogue
+    finally:
+        _load_lock.release()
+
+
+def search(load_index, query="", filters=None, offset=0, limit=20):
+    catalogue = get_catalogue(load_index)
+    # The catalogue is updated in place, so it can't be searched at the same time
+    with _lock:
+        return catalogue.search(query, filters, offset, limit)
+
+
+def index_changed(model_name, metadata):
+    # Called with the index.json lock held, straight after the index was written
+    global _catalogue_version
+    version = uuid.uuid4().hex
+    with _lock:
+        previous_version = cache.get(CATALOGUE_VERSION_KEY)
+        cache.set(CATALOGUE_VERSION_KEY, version, None)
+        # If this process was up to date, it only needs to apply this change.
+        # Otherwise it rebuilds on the next search, like every other process.
+        if _catalogue is not None and previous_version == _catalogue_version:
+            _catalogue.upsert(model_name, metadata)
+            _catalogue_version = version
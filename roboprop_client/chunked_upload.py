@@ -0,0 +1,103 @@
+import fcntl
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from django.conf import settings
+
+# Resumable uploads: a client creates an upload, sends the file in chunks
+# (always appended at the current offset) and finalizes it once complete.
+# After a dropped connection it asks for the current offset and carries on
+# from there. Chunks are staged on local disk until the upload is finalized.
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class UploadOffsetError(ValueError):
+    def __init__(self, offset):
+        super().__init__(f"Chunk must start at offset {offset}")
+        self.offset = offset
+
+
+def _upload_dir():
+    path = Path(settings.CHUNKED_UPLOAD_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _paths(upload_id):
+    # upload_id comes from the URL, so make sure it can't point anywhere else
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        raise FileNotFoundError(f"Unknown upload: {upload_id}")
+    upload_dir = _upload_dir()
+    return upload_dir / f"{upload_id}.json", upload_dir / f"{upload_id}.part"
+
+
+def create_upload(asset_type, filename, size):
+    delete_expired_uploads()
+    upload_id = uuid.uuid4().hex
+    state_path, part_path = _paths(upload_id)
+    part_path.touch()
+    state = {
+        "upload_id": upload_id,
+        "asset_type": asset_type,
+        # Only the name is kept, any client side path is dropped
+        "filename": os.path.basename(filename),
+        "size": size,
+        "created": time.time(),
+    }
+    with open(state_path, "w") as state_file:
+        json.dump(state, state_file)
+    return get_upload(upload_id)
+
+
+def get_upload(upload_id):
+    state_path, part_path = _paths(upload_id)
+    if not state_path.exists():
+        raise FileNotFoundError(f"Unknown upload: {upload_id}")
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    state["offset"] = part_path.stat().st_size
+    return state
+
+
+def write_chunk(upload_id, offset, stream):
+    state = get_upload(upload_id)
+    _, part_path = _paths(upload_id)
+    with open(part_path, "ab") as part_file:
+        # Only one chunk can be written at a time, e.g. when a client retries
+        # a chunk while the original request is still being processed
+        fcntl.flock(part_file, fcntl.LOCK_EX)
+        current_offset = os.fstat(part_file.fileno()).st_size
+        if offset != current_offset:
+            raise UploadOffsetError(current_offset)
+        while block := stream.read(READ_BLOCK_SIZE):
+            current_offset += len(block)
+            if current_offset > state["size"]:
+                part_file.truncate(offset)
+                raise ValueError("Chunk goes past the end of the file")
+            part_file.write(block)
+    return current_offset
+
+
+def get_completed_file(upload_id):
+    state = get_upload(upload_id)
+    if state["offset"] != state["size"]:
+        raise UploadOffsetError(state["offset"])
+    _, part_path = _paths(upload_id)
+    return state, part_path
+
+
+def delete_upload(upload_id):
+    for path in _paths(upload_id):
+        path.unlink(missing_ok=True)
+
+
+def delete_expired_uploads():
+    expiry = time.time() - settings.CHUNKED_UPLOAD_EXPIRY
+    # Every chunk touches the .part file, so only abandoned uploads expire
+    for part_path in _upload_dir().glob("*.part"):
+        if part_path.stat().st_mtime < expiry:
+            delete_upload(part_path.stem)
@@ -0,0 +1,187 @@
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+from pathlib import Path
+
+# bpy holds global state, so a process can only ever convert one model at a
+# time. The pool keeps a long-lived process per core, each with its own bpy,
+# and hands every one of them a job at a time. A worker that crashes (bpy can
+# segfault on broken files) or hangs only takes its own job down with it, and
+# is replaced by a fresh process.
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", 0)) or os.cpu_count() or 1
+# Jobs taking longer than this are assumed to be stuck, 0 disables the timeout
+CONVERSION_TIMEOUT = int(os.getenv("CONVERSION_TIMEOUT", 30 * 60))
+# bpy doesn't free everything between files, so workers are recycled
+MAX_JOBS_PER_WORKER = 25
+# A job whose worker crashed is tried once more on a fresh worker, in case the
+# crash wasn't caused by that job
+CRASH_RETRIES = 1
+STOP_TIMEOUT = 5
+
+
+@dataclass
+class ConversionJob:
+    blend_file: Path
+    out_dir: Path
+    model_name: str
+    # e.g ["glb"], every format in EXPORT_CONFIGS when not set
+    formats: list = None
+
+
+@dataclass
+class ConversionResult:
+    job: ConversionJob
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _work(connection):
+    # Imported here, so bpy is only ever loaded by the workers
+    from roboprop_client.export_model import export_sdf
+
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        try:
+            export_sdf(
+                out_dir=Path(job.out_dir),
+                model_name=job.model_name,
+                blend_file_path=Path(job.blend_file),
+                formats=job.formats,
+            )
+            connection.send(None)
+        except Exception:
+            connection.send(traceback.format_exc())
+
+
+def _worker_sys_path():
+    # bpy adds its bundled script folders to sys.path when it's imported, and
+    # spawned processes start with the parent's sys.path, where those folders
+    # would shadow the bpy module itself
+    bpy = sys.modules.get("bpy")
+    if bpy is None:
+        return list(sys.path)
+    scripts_dir = str(Path(bpy.__file__).parents[2])
+    return [path for path in sys.path if not path.startswith(scripts_dir)]
+
+
+class _Worker:
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_work, args=(child_connection,), daemon=True
+        )
+        sys_path = list(sys.path)
+        sys.path[:] = _worker_sys_path()
+        try:
+            self.process.start()
+        finally:
+            sys.path[:] = sys_path
+        child_connection.close()
+        self.job = None
+        self.crashes = 0
+        self.started = None
+        self.jobs_done = 0
+
+    def run(self, job, crashes):
+        self.job = job
+        self.crashes = crashes
+        self.started = time.monotonic()
+        self.connection.send(job)
+
+    def finish(self):
+        job = self.job
+        self.job = None
+        self.jobs_done += 1
+        return job
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(STOP_TIMEOUT)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def convert(jobs, workers=None, timeout=None):
+    """
+    Runs every job across a pool of worker processes, and yields a
+    ConversionResult for each one as it finishes (in no particular order)
+    """
+    workers = workers or CONVERSION_WORKERS
+    timeout = CONVERSION_TIMEOUT if timeout is None else timeout
+    # bpy isn't safe to fork, every worker starts from a clean interpreter
+    context = multiprocessing.get_context("spawn")
+    pending = deque((job, 0) for job in jobs)
+    pool = []
+    try:
+        while pending or pool:
+            idle = [worker for worker in pool if worker.job is None]
+            while pending and (idle or len(pool) < workers):
+                if idle:
+                    worker = idle.pop()
+                else:
+                    worker = _Worker(context)
+                    pool.append(worker)
+                worker.run(*pending.popleft())
+            # Nothing left to hand out
+            for worker in idle:
+                worker.stop()
+                pool.remove(worker)
+
+            busy = [worker for worker in pool if worker.job is not None]
+            wait(
+                [worker.connection for worker in busy]
+                + [worker.process.sentinel for worker in busy],
+                timeout=1,
+            )
+            for worker in busy:
+                error = None
+                if worker.connection.poll():
+                    try:
+                        error = worker.connection.recv()
+                    except (EOFError, OSError):
+                        pass
+                    else:
+                        yield ConversionResult(worker.finish(), error)
+                        if worker.jobs_done >= MAX_JOBS_PER_WORKER:
+                            worker.stop()
+                            pool.remove(worker)
+                        continue
+                if worker.process.is_alive():
+                    if not timeout or time.monotonic() - worker.started < timeout:
+                        continue
+                    error = f"Conversion timed out after {timeout}s"
+                else:
+                    worker.process.join()
+                    if worker.crashes < CRASH_RETRIES:
+                        pending.appendleft((worker.job, worker.crashes + 1))
+                        worker.job = None
+                    else:
+                        error = f"Worker crashed (exit code {worker.process.exitcode})"
+                worker.kill()
+                pool.remove(worker)
+                if error:
+                    yield ConversionResult(worker.finish(), error)
+    finally:
+        for worker in pool:
+            if worker.job is None:
+                worker.stop()
+            else:
+                worker.kill()
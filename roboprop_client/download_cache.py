@@ -0,0 +1,161 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+# Downloaded files (i.e BlenderKit .blend files) are stored by the sha256 of
+# their content, so identical files are only kept once. Keys (e.g an asset id)
+# point at these objects, along with the size and modification time the object
+# had when it was hashed, so a file that changed on disk since is hashed again
+# before it is used. Point BLENDERKIT_CACHE_DIR at a volume shared between
+# workers to share the cache between them, file locks make sure every file is
+# only downloaded once. Least recently used files (by access time) are evicted
+# once the cache grows beyond BLENDERKIT_CACHE_MAX_BYTES.
+BLENDERKIT_CACHE_DIR = os.getenv("BLENDERKIT_CACHE_DIR", ".cache")
+BLENDERKIT_CACHE_MAX_BYTES = int(
+    os.getenv("BLENDERKIT_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+)
+# Files used this recently are never evicted, as another task may be about to
+# open the file it was just given
+EVICTION_GRACE_PERIOD = 15 * 60
+READ_BLOCK_SIZE = 1024 * 1024
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def _cache_dir():
+    path = Path(BLENDERKIT_CACHE_DIR)
+    for folder in ["objects", "refs", "locks", "tmp"]:
+        (path / folder).mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextmanager
+def _lock(name):
+    # flock works across processes, and across containers sharing a volume
+    lock_path = _cache_dir() / "locks" / f"{name}.lock"
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _object_path(sha256):
+    return _cache_dir() / "objects" / sha256[:2] / sha256
+
+
+def _ref_path(key):
+    return _cache_dir() / "refs" / f"{key}.json"
+
+
+def _write_ref(key, sha256, path):
+    stat = path.stat()
+    ref_path = _ref_path(key)
+    temp_ref_path = ref_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    with open(temp_ref_path, "w") as ref_file:
+        json.dump(
+            {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+            ref_file,
+        )
+    os.replace(temp_ref_path, ref_path)
+
+
+def _lookup(key):
+    ref_path = _ref_path(key)
+    if not ref_path.exists():
+        return None
+    with open(ref_path) as ref_file:
+        ref = json.load(ref_file)
+    path = _object_path(ref["sha256"])
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        # Evicted
+        return None
+    # Hashing a large file takes a while, so it's only done again when the file
+    # changed since it was hashed (or was stored again under another key)
+    if (stat.st_size, stat.st_mtime_ns) != (ref["size"], ref.get("mtime_ns")):
+        if file_sha256(path) != ref["sha256"]:
+            # Corrupted on disk, download it again
+            path.unlink(missing_ok=True)
+            return None
+        _write_ref(key, ref["sha256"], path)
+    # The access time is what eviction goes by, the modification time is
+    # left alone for the check above
+    os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+    return path
+
+
+def _store(key, temp_path):
+    sha256 = file_sha256(temp_path)
+    path = _object_path(sha256)
+    path.parent.mkdir(exist_ok=True)
+    # Renames are atomic, so no one ever sees a partially written object
+    os.replace(temp_path, path)
+    _write_ref(key, sha256, path)
+    return path
+
+
+def get_or_download(key, download):
+    """
+    Returns the path of the cached file for key, calling download(path) to
+    fetch it into path first if it isn't cached. path may already hold part
+    of the file from an earlier, failed attempt.
+    """
+    # The key ends up in file names
+    if not KEY_PATTERN.match(key):
+        raise ValueError(f"Invalid cache key: {key}")
+    with _lock(key):
+        path = _lookup(key)
+        if path is None:
+            # Named after the key and left behind on failure, so the next
+            # attempt can resume a partial download
+            temp_path = _cache_dir() / "tmp" / key
+            download(temp_path)
+            path = _store(key, temp_path)
+    evict(BLENDERKIT_CACHE_MAX_BYTES)
+    return path
+
+
+def evict(max_bytes):
+    with _lock("evict"):
+        objects = []
+        for path in (_cache_dir() / "objects").glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if not path.is_file():
+                continue
+            objects.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in objects)
+        now = time.time()
+        # Least recently used first
+        for atime, size, path in sorted(objects):
+            if total <= max_bytes:
+                break
+            if now - atime < EVICTION_GRACE_PERIOD:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+        # Drop partial downloads that were never resumed
+        for path in (_cache_dir() / "tmp").iterdir():
+            try:
+                if now - path.stat().st_mtime > EVICTION_GRACE_PERIOD:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                continue
@@ -1,10 +1,46 @@
+import hashlib
+import json
 import os
+import tempfile
+import zipfile
 from xml.dom import minidom
 from xml.etree import ElementTree
 from pathlib import Path
-from roboprop_client.blender_scripts.export_glb import export_glb, export_gltf
-from roboprop_client.blender_scripts.export_fbx import export_fbx
-from roboprop_client.blender_scripts.export_obj import export_obj
+import bpy
+import roboprop_client.download_cache as download_cache
+from roboprop_client.blender_scripts.collisions import (
+    COLLISION_MODE,
+    COLLISION_TRIANGLE_BUDGET,
+    create_collision_model,
+)
+from roboprop_client.blender_scripts.export_glb import (
+    GLTF_COMPRESSION,
+    GLTF_IMAGE_FORMAT,
+    GLTF_IMAGE_QUALITY,
+    export_glb_collision,
+    export_glb_visual,
+    export_gltf_collision,
+    export_gltf_visual,
+    get_glb_compression,
+    measure_decode_time,
+)
+from roboprop_client.blender_scripts.export_fbx import (
+    export_fbx_collision,
+    export_fbx_visual,
+)
+from roboprop_client.blender_scripts.export_obj import (
+    export_obj_collision,
+    export_obj_visual,
+)
+from roboprop_client.blender_scripts.session import open_scene
+from roboprop_client.blender_scripts.textures import (
+    TEXTURE_MAX_SIZE,
+    optimize_textures,
+)
+
+# Bump this whenever a change to the exporters changes their output, so models
+# converted before are converted again rather than taken from the cache
+EXPORTER_VERSION = 1
 
 EXPORT_CONFIGS = [
     {
@@ -18,9 +54,19 @@ EXPORT_CONFIGS = [
         "collision": "assets/collision.glb",
         "sdf": "glft-model.sdf",
         "config": "glft-model.config",
+        # None, "draco" or "meshopt", see export_glb.py
+        "compression": GLTF_COMPRESSION,
     },
 ]
 
+# extension -> (visual exporter, collision exporter)
+EXPORTERS = {
+    ".fbx": (export_fbx_visual, export_fbx_collision),
+    ".glb": (export_glb_visual, export_glb_collision),
+    ".gltf": (export_gltf_visual, export_gltf_collision),
+    ".obj": (export_obj_visual, export_obj_collision),
+}
+
 
 # Util for saving an XML file
 def write_xml(xml: ElementTree.Element, filepath: Path):
@@ -33,32 +79,144 @@ def write_xml(xml: ElementTree.Element, filepath: Path):
     print(f"Saved: {filepath}")
 
 
-def export_sdf(out_dir: Path, model_name: str, blend_file_path: Path):
+def _get_exporters(path: Path):
+    suffix = Path(path).suffix
+    if suffix not in EXPORTERS:
+        raise ValueError(
+            f"Exporting models the with extension '{suffix}' is not implemented yet. (Appears in {path})"
+        )
+    return EXPORTERS[suffix]
+
+
+def _get_export_configs(formats=None):
+    # formats are visual mesh extensions, e.g ["glb"], all of them when not set
+    if formats is None:
+        return EXPORT_CONFIGS
+    available = {Path(config["visual"]).suffix[1:]: config for config in EXPORT_CONFIGS}
+    unknown = set(formats) - set(available)
+    if unknown:
+        raise ValueError(
+            f"Unknown formats: {', '.join(sorted(unknown))}. Available: {', '.join(available)}"
+        )
+    return [config for format, config in available.items() if format in formats]
+
+
+def _get_export_options(export_config):
+    # Only passed on when set, as only the .glb exporters take options
+    if not export_config.get("compression"):
+        return {}
+    suffix = Path(export_config["visual"]).suffix
+    if suffix != ".glb":
+        raise ValueError(
+            f"Compression is only supported for .glb exports, not '{suffix}'. (Set for {export_config['visual']})"
+        )
+    return {"compression": export_config["compression"]}
+
+
+def _report_assets(out_dir: Path, export_configs):
+    # Decoding is only timed when compression was asked for, as it means
+    # loading every model once more
+    report = []
+    for export_config in export_configs:
+        for kind in ["visual", "collision"]:
+            path = out_dir / export_config[kind]
+            asset = {"asset": export_config[kind], "bytes": path.stat().st_size}
+            if path.suffix == ".glb":
+                asset["compression"] = get_glb_compression(path)
+                if export_config.get("compression"):
+                    asset["decode_seconds"] = measure_decode_time(path)
+            report.append(asset)
+            print(
+                ", ".join(
+                    (
+                        f"{key}: {value:.3f}"
+                        if isinstance(value, float)
+                        else f"{key}: {value}"
+                    )
+                    for key, value in asset.items()
+                )
+            )
+    return report
+
+
+def get_export_settings_key(formats=None):
+    # Everything besides the .blend file that the converted files depend on
+    settings = {
+        "export_configs": _get_export_configs(formats),
+        "exporter_version": EXPORTER_VERSION,
+        "blender_version": bpy.app.version_string,
+        "collision": [COLLISION_MODE, COLLISION_TRIANGLE_BUDGET],
+        "textures": [TEXTURE_MAX_SIZE, GLTF_IMAGE_FORMAT, GLTF_IMAGE_QUALITY],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def get_conversion_key(blend_sha256: str, model_name: str, formats=None):
+    key = f"{blend_sha256}/{model_name}/{get_export_settings_key(formats)}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def export_sdf_cached(
+    out_dir: Path, model_name: str, blend_file_path: Path, conversion_key=None
+):
+    """
+    export_sdf, reusing the files of an earlier conversion with the same
+    conversion key when there is one. Returns the conversion key.
+    """
+    if conversion_key is None:
+        conversion_key = get_conversion_key(
+            download_cache.file_sha256(blend_file_path), model_name
+        )
+
+    def convert(destination):
+        with tempfile.TemporaryDirectory() as work_dir:
+            export_sdf(Path(work_dir), model_name, blend_file_path)
+            with zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED) as archive:
+                for path in Path(work_dir).rglob("*"):
+                    if path.is_file():
+                        archive.write(path, path.relative_to(work_dir))
+
+    # Kept in the download cache, so workers sharing it share conversions too,
+    # and the same model is never converted by two workers at once
+    archive_path = download_cache.get_or_download(
+        f"conversion-{conversion_key}", convert
+    )
+    with zipfile.ZipFile(archive_path) as archive:
+        archive.extractall(out_dir)
+    return conversion_key
+
+
+def export_sdf(out_dir: Path, model_name: str, blend_file_path: Path, formats=None):
     sdf_version = "1.9"
+    export_configs = _get_export_configs(formats)
 
-    for export_config in EXPORT_CONFIGS:
+    # The scene is loaded once for every format. All visual models are exported
+    # first, as building the collision model changes the scene in place.
+    with open_scene(blend_file_path) as work_dir:
+        optimize_textures(work_dir)
+        for export_config in export_configs:
+            visual_path = out_dir / export_config["visual"]
+            export_visual, _ = _get_exporters(visual_path)
+            os.makedirs(name=os.path.dirname(visual_path), exist_ok=True)
+            export_visual(visual_path, **_get_export_options(export_config))
+            print(f"Saved {visual_path}")
+
+        create_collision_model()
+        for export_config in export_configs:
+            collision_path = out_dir / export_config["collision"]
+            _, export_collision = _get_exporters(collision_path)
+            os.makedirs(name=os.path.dirname(collision_path), exist_ok=True)
+            export_collision(collision_path, **_get_export_options(export_config))
+            print(f"Saved {collision_path}")
+
+        report = _report_assets(out_dir, export_configs)
+
+    for export_config in export_configs:
         visual_path = out_dir / export_config["visual"]
         collision_path = out_dir / export_config["collision"]
         sdf_path = out_dir / export_config["sdf"]
         config_path = out_dir / export_config["config"]
 
-        # Export visual model
-        os.makedirs(name=os.path.dirname(visual_path), exist_ok=True)
-        if Path(visual_path).suffix == ".fbx":
-            export_fbx(blend_file_path, visual_path, collision_path)
-        elif Path(visual_path).suffix == ".glb":
-            export_glb(blend_file_path, visual_path, collision_path)
-        elif Path(visual_path).suffix == ".gltf":
-            export_gltf(blend_file_path, visual_path, collision_path)
-        elif Path(visual_path).suffix == ".obj":
-            export_obj(blend_file_path, visual_path, collision_path)
-        else:
-            raise ValueError(
-                f"Exporting models the with extension '{Path(visual_path).suffix}' is not implemented yet. (Appears in {visual_path})"
-            )
-
-        print(f"Saved {visual_path}")
-
         # Generate SDF
         sdf = ElementTree.Element("sdf", attrib={"version": sdf_version})
         model = ElementTree.SubElement(sdf, "model", attrib={"name": model_name})
@@ -108,3 +266,5 @@ def export_sdf(out_dir: Path, model_name: str, blend_file_path: Path):
         sdf_tag.text = os.path.relpath(sdf_path, os.path.dirname(config_path))
 
         write_xml(model_config, config_path)
+
+    return report
@@ -0,0 +1,98 @@
+import os
+import threading
+import uuid
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP client for all file server (DreamFactory) traffic, so requests
+# reuse pooled keep-alive connections instead of opening a new one every time.
+FILESERVER_POOL_SIZE = int(os.getenv("FILESERVER_POOL_SIZE", 10))
+FILESERVER_CONNECT_TIMEOUT = float(os.getenv("FILESERVER_CONNECT_TIMEOUT", 5))
+FILESERVER_READ_TIMEOUT = float(os.getenv("FILESERVER_READ_TIMEOUT", 60))
+FILESERVER_RETRIES = int(os.getenv("FILESERVER_RETRIES", 3))
+FILESERVER_RETRY_BACKOFF = float(os.getenv("FILESERVER_RETRY_BACKOFF", 0.5))
+
+# Only idempotent requests are retried, never POSTs (uploads, logins...)
+RETRY_METHODS = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS"])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+_local = threading.local()
+
+
+def _create_session():
+    retry = Retry(
+        total=FILESERVER_RETRIES,
+        backoff_factor=FILESERVER_RETRY_BACKOFF,
+        allowed_methods=RETRY_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        # Return the last response rather than raising, like a plain request would
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=FILESERVER_POOL_SIZE,
+        pool_maxsize=FILESERVER_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    # One session per thread, as requests doesn't guarantee Session is thread
+    # safe. gunicorn and Celery fork their workers, so a session inherited from
+    # the parent process is replaced rather than sharing its sockets.
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        _local.session = _create_session()
+        _local.pid = pid
+    return _local.session
+
+
+def request(method, url, timeout=None, **kwargs):
+    if timeout is None:
+        timeout = (FILESERVER_CONNECT_TIMEOUT, FILESERVER_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (FILESERVER_CONNECT_TIMEOUT, timeout)
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+class MultipartFileStream:
+    # A multipart/form-data body that reads the file as it is being sent, so
+    # uploads never hold the whole file in memory. requests sends any object
+    # with read() block by block, and uses `len` for the Content-Length.
+    def __init__(self, field_name, filename, file):
+        boundary = uuid.uuid4().hex
+        filename = filename.replace('"', "%22")
+        header = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        footer = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.len = len(header) + _remaining_size(file) + len(footer)
+        self._parts = [BytesIO(header), file, BytesIO(footer)]
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def _remaining_size(file):
+    position = file.tell()
+    file.seek(0, os.SEEK_END)
+    size = file.tell() - position
+    file.seek(position)
+    return size
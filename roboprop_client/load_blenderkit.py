@@ -1,24 +1,175 @@
 import uuid
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 import requests
 import argparse
 import json
+import roboprop_client.download_cache as download_cache
 import roboprop_client.utils as utils
-from roboprop_client.export_model import export_sdf
-
-CACHE_PATH = Path(".cache")
-
-
-def download_large_file(url, destination):
-    response = requests.get(url, stream=True)
-    response.raise_for_status()  # Ensure we got an OK response
-
-    with open(destination, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            # if chunk:
-            f.write(chunk)
+from roboprop_client.export_model import export_sdf_cached, get_conversion_key
+
+# Large files are fetched as several ranges at once, over separate connections
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", 4))
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = (10, 60)
+PROGRESS_INTERVAL = 1
+
+
+def _probe(url):
+    # A one byte Range request tells whether the server supports ranges, and
+    # how big the file is. HEAD isn't an option, as signed URLs are only
+    # valid for GET.
+    with requests.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and "/" in content_range:
+            size = content_range.split("/")[1]
+            if size.isdigit():
+                return int(size), True
+        size = response.headers.get("Content-Length")
+        return int(size) if size and size.isdigit() else None, False
+
+
+def _iter_chunks(response):
+    # Chunks grow while data arrives quickly and shrink again when it doesn't,
+    # so fast connections aren't held back by small reads and progress is
+    # still saved regularly on slow ones.
+    chunk_size = MIN_CHUNK_SIZE
+    while True:
+        start = time.monotonic()
+        chunk = response.raw.read(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+        elapsed = time.monotonic() - start
+        if elapsed < 0.25 and chunk_size < MAX_CHUNK_SIZE:
+            chunk_size *= 2
+        elif elapsed > 1 and chunk_size > MIN_CHUNK_SIZE:
+            chunk_size //= 2
+
+
+def _download_segment(url, fd, segment, done, index):
+    start, end = segment
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if start + done[index] > end:
+            return
+        try:
+            # Carries on from wherever the last attempt got to
+            headers = {"Range": f"bytes={start + done[index]}-{end}"}
+            with requests.get(
+                url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+            ) as response:
+                if response.status_code != 206:
+                    raise requests.HTTPError(
+                        f"Expected a partial response, got {response.status_code}",
+                        response=response,
+                    )
+                for chunk in _iter_chunks(response):
+                    os.pwrite(fd, chunk, start + done[index])
+                    done[index] += len(chunk)
+        except (requests.RequestException, OSError):
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            time.sleep(2**attempt)
+    if start + done[index] <= end:
+        raise IOError(f"Segment {start}-{end} ended early")
+
+
+def _load_download_state(state_path, size):
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    # The file changed on the server since, start over
+    if state.get("size") != size:
+        return None
+    return state
+
+
+def _save_download_state(state_path, state):
+    temp_path = state_path.with_suffix(".tmp")
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_path, state_path)
+
+
+def _download_stream(url, destination, progress=None):
+    # For servers without Range support, one connection from the start
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length") or 0) or None
+        started = time.monotonic()
+        reported = started
+        downloaded = 0
+        with open(destination, "wb") as f:
+            for chunk in _iter_chunks(response):
+                f.write(chunk)
+                downloaded += len(chunk)
+                now = time.monotonic()
+                if progress and now - reported >= PROGRESS_INTERVAL:
+                    progress(downloaded, size, downloaded / (now - started))
+                    reported = now
+
+
+def download_large_file(url, destination, progress=None):
+    """
+    Downloads url to destination in DOWNLOAD_SEGMENTS parallel ranges.
+    An interrupted download carries on from where it stopped the next time it
+    is called with the same destination. progress(downloaded, total,
+    bytes_per_second) is called about every PROGRESS_INTERVAL seconds.
+    """
+    destination = Path(destination)
+    size, ranges_supported = _probe(url)
+    if not ranges_supported or not size:
+        _download_stream(url, destination, progress)
+        return
+
+    state_path = destination.with_name(destination.name + ".parts.json")
+    state = _load_download_state(state_path, size) if destination.exists() else None
+    if state is None:
+        count = max(1, min(DOWNLOAD_SEGMENTS, size // MIN_SEGMENT_SIZE))
+        bounds = [size * i // count for i in range(count + 1)]
+        state = {
+            "size": size,
+            "segments": [[bounds[i], bounds[i + 1] - 1] for i in range(count)],
+            "done": [0] * count,
+        }
+        with open(destination, "wb") as f:
+            f.truncate(size)
+        _save_download_state(state_path, state)
+
+    done = state["done"]
+    fd = os.open(destination, os.O_WRONLY)
+    started = time.monotonic()
+    resumed_from = sum(done)
+    try:
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as executor:
+            futures = [
+                executor.submit(_download_segment, url, fd, segment, done, index)
+                for index, segment in enumerate(state["segments"])
+            ]
+            pending = futures
+            while pending:
+                _, pending = wait(pending, timeout=PROGRESS_INTERVAL)
+                # Written data is only recorded after it went to the file
+                _save_download_state(state_path, state)
+                if progress:
+                    elapsed = max(time.monotonic() - started, 1e-6)
+                    progress(sum(done), size, (sum(done) - resumed_from) / elapsed)
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+        _save_download_state(state_path, state)
+    state_path.unlink()
 
 
 def load_asset_meta(asset_base_id: str):
@@ -35,19 +186,9 @@ def load_asset_meta(asset_base_id: str):
     return data["results"][0]
 
 
-def load_model_from_blenderkit(meta) -> Path:
+def load_model_from_blenderkit(meta, progress=None) -> Path:
     asset_id = meta["id"]
 
-    # Create output directory
-    output_folder = CACHE_PATH / asset_id
-    output_folder.mkdir(exist_ok=True, parents=True)
-    # Set temp path for downloading. This allows clean stop and continue of the script
-    temp_path = output_folder / "temp.blend"
-
-    output_path = output_folder / "model.blend"
-    if output_path.exists():
-        return output_path
-
     # Try to find url to blend file
     download_url = None
     for file in meta["files"]:
@@ -57,29 +198,30 @@ def load_model_from_blenderkit(meta) -> Path:
     if download_url is None:
         raise ValueError("Error: No blend file found for this model meta")
 
-    # Create a random scene uuid which is necessary for downloading files
-    scene_uuid = str(uuid.uuid4())
-
-    download_url = download_url + "?scene_uuid=" + scene_uuid
-    # Download metadata for blend file
-    if len(utils.BLENDERKIT_PRO_API_KEY) == 0:
-        # Can only use free models, so no API key is needed
-        response = requests.get(download_url)
-    else:
-        # Having an API key = having a subscription
-        response = requests.get(
-            download_url,
-            headers={"Authorization": "Bearer " + utils.BLENDERKIT_PRO_API_KEY},
-        )
-    data = response.json()
-    if response.status_code == 401:
-        raise ValueError("Error: Blenderkit API Key is invalid or expired")
-    # Extract actual download path
-    file_path = data["filePath"]
-    # Download the file
-    download_large_file(file_path, str(temp_path))
-    temp_path.rename(output_path)
-    return output_path
+    def download(destination):
+        # Create a random scene uuid which is necessary for downloading files
+        scene_uuid = str(uuid.uuid4())
+        url = download_url + "?scene_uuid=" + scene_uuid
+        # Download metadata for blend file
+        if len(utils.BLENDERKIT_PRO_API_KEY) == 0:
+            # Can only use free models, so no API key is needed
+            response = requests.get(url)
+        else:
+            # Having an API key = having a subscription
+            response = requests.get(
+                url,
+                headers={"Authorization": "Bearer " + utils.BLENDERKIT_PRO_API_KEY},
+            )
+        if response.status_code == 401:
+            raise ValueError("Error: Blenderkit API Key is invalid or expired")
+        data = response.json()
+        # Extract actual download path
+        file_path = data["filePath"]
+        # Download the file
+        download_large_file(file_path, destination, progress)
+
+    # Only downloaded if it isn't in the cache yet
+    return download_cache.get_or_download(asset_id, download)
 
 
 def add_demo_world(model_path: Path):
@@ -96,26 +238,45 @@ def add_demo_world(model_path: Path):
 
 
 def load_blenderkit_model(
-    asset_base_id: str, output_path: str, model_name: str | None = None
+    asset_base_id: str,
+    output_path: str,
+    model_name: str | None = None,
+    progress=None,
+    previous_conversion_key=None,
 ):
+    """
+    Converts the model, and returns its conversion key. Returns None without
+    converting anything if the key is previous_conversion_key, i.e neither the
+    .blend file nor the export settings have changed since then.
+    """
     # Load asset meta data from BlenderKit
     meta = load_asset_meta(asset_base_id)
 
     if not model_name:
         model_name = meta["name"]
 
-    blend_file = load_model_from_blenderkit(meta)
+    blend_file = load_model_from_blenderkit(meta, progress)
+    # Cached files are named after their sha256
+    conversion_key = get_conversion_key(blend_file.name, model_name)
+    if conversion_key == previous_conversion_key:
+        return None
     model_path = Path(output_path) / model_name
     # objs = bproc.loader.load_blend(blend_file)
     # bpy.ops.wm.open_mainfile(filepath=blend_file)
     # bpy.ops.file.unpack_all(method="USE_LOCAL")
-    export_sdf(out_dir=model_path, model_name=model_name, blend_file_path=blend_file)
+    export_sdf_cached(
+        out_dir=model_path,
+        model_name=model_name,
+        blend_file_path=blend_file,
+        conversion_key=conversion_key,
+    )
     # Save meta data in the model folder
     meta_path = model_path / "blenderkit_meta.json"
     with open(meta_path, "w") as f:
         json.dump(meta, f, indent=4)
 
     demo_path = add_demo_world(model_path)
+    return conversion_key
 
 
 def main(args):
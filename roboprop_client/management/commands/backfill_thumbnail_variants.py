@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+import roboprop_client.utils as utils
+from roboprop_client.thumbnails import THUMBNAIL_VARIANTS
+
+
+class Command(BaseCommand):
+    help = "Create resized thumbnail variants for assets uploaded before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--asset-type",
+            choices=["models", "robots"],
+            action="append",
+            help="Only backfill this asset type (can be repeated)",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            default=False,
+            help=f"Regenerate existing variants ({', '.join(THUMBNAIL_VARIANTS)})",
+        )
+
+    def handle(self, *args, **options):
+        for asset_type in options["asset_type"] or ["models", "robots"]:
+            response = utils.make_get_request(f"files/{asset_type}/")
+            if response.status_code != 200:
+                self.stderr.write(f"Failed to list {asset_type}")
+                continue
+            for item in response.json()["resource"]:
+                if item["type"] != "folder":
+                    continue
+                created = utils.add_thumbnail_variants(
+                    asset_type, item["name"], force=options["force"]
+                )
+                if created:
+                    self.stdout.write(
+                        f"{asset_type}/{item['name']}: created {', '.join(created)}"
+                    )
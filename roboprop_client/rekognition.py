@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from django.core.cache import cache
+
+# Suggests tags, categories and colors for a model from its thumbnails, using
+# AWS Rekognition's label detection.
+REKOGNITION_WORKERS = int(os.getenv("REKOGNITION_WORKERS", 4))
+# e.g. a local stub of the Rekognition API, AWS itself when not set
+REKOGNITION_ENDPOINT_URL = os.getenv("REKOGNITION_ENDPOINT_URL") or None
+# Labels only depend on the image, so they can be kept for a long time
+REKOGNITION_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+# Confidence can be tweaked, and a lower value does return
+# more (and sometimes correct) results, but also more noise.
+MIN_CONFIDENCE = 90
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=REKOGNITION_WORKERS)
+
+
+def get_client():
+    # boto3 clients are thread safe, so every thread shares the same one and
+    # its connection pool. Celery forks its workers, so a client inherited from
+    # the parent process is replaced rather than sharing its sockets.
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = boto3.client(
+                "rekognition",
+                endpoint_url=REKOGNITION_ENDPOINT_URL,
+                config=Config(
+                    max_pool_connections=REKOGNITION_WORKERS,
+                    retries={"max_attempts": 3, "mode": "standard"},
+                ),
+            )
+            _client_pid = os.getpid()
+        return _client
+
+
+def detect_labels(image):
+    # Keyed on the image itself, so re-imports and duplicate thumbnails are
+    # only ever sent to Rekognition once
+    cache_key = f"rekognition_labels_{hashlib.sha256(image).hexdigest()}"
+    labels = cache.get(cache_key)
+    if labels is None:
+        response = get_client().detect_labels(
+            Image={"Bytes": image},
+            Features=["GENERAL_LABELS", "IMAGE_PROPERTIES"],
+            MinConfidence=MIN_CONFIDENCE,
+        )
+        labels = response["Labels"]
+        cache.set(cache_key, labels, REKOGNITION_CACHE_TIMEOUT)
+    return labels
+
+
+def _detect_labels_or_none(image):
+    # A thumbnail Rekognition can't handle only loses its own suggestions
+    try:
+        return detect_labels(image)
+    except Exception:
+        return None
+
+
+class _Tally:
+    def __init__(self):
+        self.counts = Counter()
+        self.confidence = Counter()
+
+    def add(self, name, confidence):
+        self.counts[name] += 1
+        self.confidence[name] += confidence
+
+    def ranked(self):
+        # Anything seen only once is most likely an outlier. The rest is ranked
+        # by how often, and how confidently, it was seen.
+        return [
+            name
+            for name, _ in sorted(
+                self.confidence.items(), key=lambda item: (-item[1], item[0])
+            )
+            if self.counts[name] > 1
+        ]
+
+
+def aggregate_labels(labels_per_image):
+    """
+    Tallies the labels of any number of images into ranked tags, categories
+    and colors, in a single pass
+    """
+    tags, categories, colors = _Tally(), _Tally(), _Tally()
+    for labels in labels_per_image:
+        for label in labels:
+            confidence = label.get("Confidence", MIN_CONFIDENCE)
+            tags.add(label["Name"], confidence)
+            categories.add(label["Categories"][0]["Name"], confidence)
+            if len(label["Parents"]) > 0:
+                categories.add(label["Parents"][0]["Name"], confidence)
+            if len(label["Instances"]) > 0:
+                for dominant_color in label["Instances"][0]["DominantColors"]:
+                    colors.add(dominant_color["SimplifiedColor"], confidence)
+    return tags.ranked(), categories.ranked(), colors.ranked()
+
+
+def get_suggested_tags(images):
+    # Identical thumbnails are labelled once, but still count once each
+    unique_images = list(dict.fromkeys(images))
+    labels = dict(
+        zip(unique_images, _executor.map(_detect_labels_or_none, unique_images))
+    )
+    return aggregate_labels(
+        labels[image] for image in images if labels[image] is not None
+    )
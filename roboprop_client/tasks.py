@@ -2,23 +2,122 @@ from celery import shared_task
 from roboprop_client.utils import (
     add_blenderkit_model_to_my_models,
     add_blenderkit_model_metadata,
+    add_thumbnail_variants,
+    get_blenderkit_assets,
+    get_blenderkit_revision,
+    get_index,
+    get_thumbnail_images,
+    update_index,
 )
+from roboprop_client.export_model import get_export_settings_key
+from roboprop_client.rekognition import get_suggested_tags
 
 
-@shared_task
+@shared_task(bind=True)
 def add_blenderkit_model_to_my_models_task(
-    folder_name, asset_base_id, thumbnail, index
+    self, folder_name, asset_base_id, thumbnail, revision=None
 ):
+    def progress(downloaded, total, bytes_per_second):
+        # Shown by task_status while the .blend file downloads
+        self.update_state(
+            state="PROGRESS",
+            meta={
+                "step": "download",
+                "downloaded": downloaded,
+                "total": total,
+                "bytes_per_second": round(bytes_per_second),
+            },
+        )
+
     try:
-        response = add_blenderkit_model_to_my_models(
-            folder_name, asset_base_id, thumbnail
+        response, conversion_key = add_blenderkit_model_to_my_models(
+            folder_name, asset_base_id, thumbnail, progress
         )
+        if response is None:
+            # Still recorded, so the next update doesn't check this revision again
+            add_blenderkit_model_metadata(
+                folder_name, asset_base_id, conversion_key, revision
+            )
+            return {"unchanged": folder_name}
         if response.status_code == 201:
             metadata_response = add_blenderkit_model_metadata(
-                folder_name, asset_base_id, index
+                folder_name, asset_base_id, conversion_key, revision
             )
             return metadata_response.json()
         return response.status_code
     except Exception as e:
         # Handle exceptions as needed
         return str(e)
+
+
+@shared_task
+def update_models_from_blenderkit_task():
+    """
+    Queues a conversion for every BlenderKit model in index.json that changed
+    on BlenderKit, or was converted with other export settings, since it was
+    last converted
+    """
+    index = get_index()
+    if index is None:
+        raise ValueError("Failed to fetch index.json")
+    models = {
+        name: metadata
+        for name, metadata in index.items()
+        if metadata.get("assetBaseId")
+    }
+    assets = get_blenderkit_assets(
+        [metadata["assetBaseId"] for metadata in models.values()]
+    )
+    export_settings_key = get_export_settings_key()
+
+    summary = {"queued": [], "skipped": [], "failed": []}
+    for name, metadata in models.items():
+        asset = assets[metadata["assetBaseId"]]
+        if asset is None:
+            summary["failed"].append(name)
+            continue
+        revision = get_blenderkit_revision(asset)
+        if (
+            metadata.get("blenderkitRevision") == revision
+            and metadata.get("exportSettingsKey") == export_settings_key
+        ):
+            summary["skipped"].append(name)
+            continue
+        thumbnail = asset.get("thumbnailMiddleUrl")
+        if not thumbnail:
+            summary["failed"].append(name)
+            continue
+        task = add_blenderkit_model_to_my_models_task.delay(
+            name, metadata["assetBaseId"], thumbnail, revision
+        )
+        summary["queued"].append({"name": name, "task_id": task.id})
+    return summary
+
+
+@shared_task
+def add_thumbnail_variants_task(asset_type, asset_name):
+    return add_thumbnail_variants(asset_type, asset_name)
+
+
+def _suggest_metadata(asset_type, asset_name):
+    # The downscaled "rekognition" thumbnails when there are any, see thumbnails.py
+    images = get_thumbnail_images(asset_type, asset_name, "rekognition")
+    tags, categories, colors = [], [], []
+    if images:
+        tags, categories, colors = get_suggested_tags(images)
+    return {"tags": tags, "categories": categories, "colors": colors}
+
+
+@shared_task
+def suggest_metadata_task(asset_type, asset_name):
+    return _suggest_metadata(asset_type, asset_name)
+
+
+@shared_task
+def add_fuel_model_metadata_task(name, description):
+    metadata = _suggest_metadata("models", name)
+    metadata["description"] = description
+    response = update_index(name, metadata, "Fuel")
+    if response.status_code != 201:
+        raise ValueError(f"Failed to tag {name}: {response.status_code}")
+    return metadata
@@ -1,27 +1,66 @@
 import roboprop_client.utils as utils
+import roboprop_client.asset_cache as asset_cache
+import roboprop_client.catalogue as catalogue
+import roboprop_client.conversion_pool as conversion_pool
+import roboprop_client.chunked_upload as chunked_upload
+import roboprop_client.blender_scripts.collisions as collisions
+import roboprop_client.blender_scripts.export_glb as export_glb
+import roboprop_client.blender_scripts.textures as textures
+import roboprop_client.download_cache as download_cache
+import roboprop_client.export_model as export_model
+import roboprop_client.fileserver as fileserver
+import roboprop_client.load_blenderkit as load_blenderkit
+import roboprop_client.rekognition as rekognition
+import roboprop_client.thumbnails as thumbnails
+import roboprop_client.views as views
 import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+import boto3
+import bpy
+import numpy as np
+import redis
+import requests
+from botocore.stub import Stubber
 from unittest.mock import patch, Mock, ANY
-from django.test import TestCase, Client, RequestFactory
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.http import Http404, HttpResponse
 from django.urls import reverse
-from django.core.cache import cache
+from django.core.cache import cache, caches
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.messages import get_messages
 from django.contrib.messages.storage.fallback import FallbackStorage
 from roboprop_client.views import (
+    _get_all_thumbnails,
     _get_assets,
+    _get_num_assets,
     _get_thumbnails,
     _search_and_cache,
     add_to_my_models,
+    login_required,
+    logout,
     mymodel_detail,
     mymodels,
+    thumbnail,
 )
-from roboprop_client.tasks import add_blenderkit_model_to_my_models_task
+from roboprop_client.tasks import (
+    add_blenderkit_model_to_my_models_task,
+    update_models_from_blenderkit_task,
+)
+from roboprop_client.blender_scripts.session import open_scene
 
 
 class ViewsTestCase(TestCase):
     def setUp(self):
         self.mock_response = Mock()
         self.mock_response.status_code = 200
+        caches["thumbnails"].clear()
+        asset_cache.invalidate_asset_listing("models")
 
     def test_get_assets(self):
         self.mock_response.json.return_value = {
@@ -36,20 +75,143 @@ class ViewsTestCase(TestCase):
             models = _get_assets("https://example.com/api/")
             self.assertEqual(models, ["model1"])
 
+    def test_get_asset_listing_cached(self):
+        self.mock_response.json.return_value = {
+            "resource": [
+                {"type": "folder", "name": "table"},
+                {"type": "folder", "name": "Chair"},
+            ]
+        }
+        with patch(
+            "roboprop_client.utils.make_get_request", return_value=self.mock_response
+        ) as mock_make_get_request:
+            self.assertEqual(_get_num_assets("models"), 2)
+            thumbnails = _get_all_thumbnails("models", page=2, page_size=1)
+            self.assertEqual(thumbnails[0]["name"], "table")
+            # Counting and paging share a single folder listing
+            folder_requests = [
+                call
+                for call in mock_make_get_request.call_args_list
+                if call.args[0] == "files/models/"
+            ]
+            self.assertEqual(len(folder_requests), 1)
+
+            asset_cache.invalidate_asset_listing("models")
+            _get_num_assets("models")
+            self.assertEqual(mock_make_get_request.call_args.args[0], "files/models/")
+
     def test_get_asset_thumbnails(self):
         self.mock_response.json.return_value = {
-            "resource": [{"path": "/path/to/thumbnail.png"}]
+            "resource": [{"type": "file", "path": "path/to/thumbnail.png"}]
         }
-        self.mock_response.content = b"example content"
         with patch(
             "roboprop_client.utils.make_get_request", return_value=self.mock_response
-        ), patch(
-            "roboprop_client.views.base64.b64encode", return_value=b"example base64"
         ):
             thumbnails = _get_thumbnails(["model1"], "models")
+            version = asset_cache.get_thumbnail_version("models", "model1")
             self.assertEqual(
                 thumbnails,
-                [{"name": "model1", "image": "example base64"}],
+                [
+                    {
+                        "name": "model1",
+                        "image": f"/thumbnails/models/model1/0/?v={version}&variant=gallery",
+                    }
+                ],
+            )
+
+    def test_get_asset_thumbnails_placeholder_on_failure(self):
+        self.mock_response.json.return_value = {
+            "resource": [{"type": "file", "path": "path/to/thumbnail.png"}]
+        }
+
+        def make_get_request(url, session_token=None, timeout=None):
+            if url.startswith("files/models/broken/"):
+                raise requests.Timeout()
+            return self.mock_response
+
+        with patch(
+            "roboprop_client.utils.make_get_request", side_effect=make_get_request
+        ):
+            thumbnails = _get_thumbnails(["model1", "broken", "model2"], "models")
+            # Order is kept, and only the failing asset falls back to a placeholder
+            self.assertEqual(
+                [(thumbnail["name"], thumbnail["image"]) for thumbnail in thumbnails],
+                [
+                    ("model1", ANY),
+                    ("broken", None),
+                    ("model2", ANY),
+                ],
+            )
+            self.assertIsNotNone(thumbnails[0]["image"])
+
+    def test_get_thumbnail_images_cached(self):
+        self.mock_response.json.return_value = {
+            "resource": [{"type": "file", "path": "path/to/thumbnail.png"}]
+        }
+        self.mock_response.content = b"example content"
+        self.mock_response.headers = {"Content-Type": "image/png"}
+        with patch(
+            "roboprop_client.utils.make_get_request", return_value=self.mock_response
+        ) as mock_make_get_request:
+            images = utils.get_thumbnail_images("models", "model1", "rekognition")
+            self.assertEqual(images, [b"example content"])
+            self.assertEqual(mock_make_get_request.call_count, 2)
+
+            # Repeat views are served from the cache
+            self.assertEqual(
+                utils.get_thumbnail_images("models", "model1", "rekognition"), images
+            )
+            self.assertEqual(mock_make_get_request.call_count, 2)
+
+            # Until the asset is uploaded again
+            asset_cache.invalidate_thumbnails("models", "model1")
+            utils.get_thumbnail_images("models", "model1", "rekognition")
+            self.assertEqual(mock_make_get_request.call_count, 4)
+
+    def test_thumbnail(self):
+        self.mock_response.json.return_value = {
+            "resource": [{"type": "file", "path": "path/to/thumbnail.png"}]
+        }
+        self.mock_response.content = b"example content"
+        self.mock_response.headers = {"Content-Type": "image/png"}
+        with patch(
+            "roboprop_client.utils.make_get_request", return_value=self.mock_response
+        ):
+            factory = RequestFactory()
+            request = factory.get("/thumbnails/models/model1/0/")
+            request.session = {"session_token": "dummy_token"}
+            response = thumbnail(request, "models", "model1", 0)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b"example content")
+            self.assertEqual(response["Content-Type"], "image/png")
+            self.assertIn("max-age", response["Cache-Control"])
+
+            # The browser revalidating its copy gets a 304
+            request = factory.get(
+                "/thumbnails/models/model1/0/", HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+            request.session = {"session_token": "dummy_token"}
+            response = thumbnail(request, "models", "model1", 0)
+            self.assertEqual(response.status_code, 304)
+
+            with self.assertRaises(Http404):
+                thumbnail(request, "models", "model1", 1)
+
+    def test_get_thumbnail_images_prefers_variant(self):
+        self.mock_response.json.return_value = {
+            "resource": [
+                {"type": "file", "path": "path/to/thumbnail.png"},
+                {"type": "folder", "name": "rekognition"},
+            ]
+        }
+        self.mock_response.content = b"example content"
+        self.mock_response.headers = {"Content-Type": "image/jpeg"}
+        with patch(
+            "roboprop_client.utils.make_get_request", return_value=self.mock_response
+        ) as mock_make_get_request:
+            utils.get_thumbnail_images("models", "model1", "rekognition")
+            mock_make_get_request.assert_called_with(
+                "files/path/to/rekognition/thumbnail.jpg", timeout=ANY
             )
 
     @patch("roboprop_client.views._get_thumbnails")
@@ -77,8 +239,53 @@ class ViewsTestCase(TestCase):
             self.assertContains(response, "thumbnail.jpg")
             self.assertContains(response, "1.0")
 
+    @patch("roboprop_client.views._is_valid_session", return_value=True)
+    @patch("roboprop_client.utils.update_index", side_effect=TimeoutError)
+    def test_add_metadata_index_locked(self, mock_update_index, mock_is_valid_session):
+        request = RequestFactory().post("/add-metadata/Chair/", {"tags": ["chair"]})
+        request.session = {"session_token": "dummy_token"}
+        setattr(request, "_messages", FallbackStorage(request))
+        response = views.add_metadata(request, "Chair")
+        # The form is shown again, to be sent once the index is free
+        self.assertEqual(response.status_code, 503)
+        self.assertContains(response, 'value="chair"', status_code=503)
+
+
+class LoginRequiredTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def _request(self):
+        request = self.factory.get("/")
+        request.session = {"session_token": "dummy_token", "admin": False}
+        setattr(request, "_messages", FallbackStorage(request))
+        return request
+
+    @patch("roboprop_client.utils.make_delete_request")
+    @patch("roboprop_client.utils.make_get_request")
+    def test_session_validation_cached(
+        self, mock_make_get_request, mock_make_delete_request
+    ):
+        mock_make_get_request.return_value = Mock(status_code=200)
+        mock_make_delete_request.return_value = Mock(status_code=200)
+        view = login_required(lambda request: HttpResponse("ok"))
+
+        self.assertEqual(view(self._request()).status_code, 200)
+        self.assertEqual(view(self._request()).status_code, 200)
+        # Only the first request is checked with DreamFactory
+        mock_make_get_request.assert_called_once_with("user/session", "dummy_token")
+
+        # Logging out forgets the session straight away
+        logout(self._request())
+        mock_make_get_request.return_value = Mock(status_code=401)
+        self.assertEqual(view(self._request()).status_code, 302)
+
 
 class SearchAndCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
     @patch("roboprop_client.views._search_external_library")
     def test_search_and_cache(self, mock_search_external_library):
         # Set up the mock
@@ -89,7 +296,7 @@ class SearchAndCacheTestCase(TestCase):
 
         # Check that the mocks were called with the expected URLs
         mock_search_external_library.assert_any_call(
-            "https://fuel.gazebosim.org/1.0/models?q=test", "fuel"
+            "https://fuel.gazebosim.org/1.0/models?q=test&page=1", "fuel"
         )
         mock_search_external_library.assert_any_call(
             "https://www.blenderkit.com/api/v1/search/?query=search+text:test+asset_type:model+order:_score+is_free:False&page=1",
@@ -106,6 +313,146 @@ class SearchAndCacheTestCase(TestCase):
         # Check that the function returned the cached results
         self.assertEqual(search_results, cached_results)
 
+    @patch("roboprop_client.views._search_external_library")
+    def test_search_partial_results(self, mock_search_external_library):
+        def search_external_library(query, library):
+            if library == "blenderkit":
+                raise requests.Timeout()
+            return [{"name": "Chair"}]
+
+        mock_search_external_library.side_effect = search_external_library
+        search_results = _search_and_cache("chair")
+        self.assertEqual(search_results["fuel"], [{"name": "Chair"}])
+        self.assertEqual(search_results["blenderkit"], [])
+        self.assertEqual(search_results["unavailable"], ["blenderkit"])
+
+        # Complete results from before are kept over partial ones
+        complete_results = {"fuel": [], "blenderkit": [{}], "unavailable": []}
+        cache.set("search_results_chair", complete_results)
+        cache.delete("search_results_chair_fresh")
+        views._refresh_search_results("chair", "search_results_chair")
+        self.assertEqual(cache.get("search_results_chair"), complete_results)
+
+    @patch.dict(
+        "roboprop_client.views.SEARCH_PROVIDERS",
+        {
+            "slow": views.SearchProvider(
+                lambda search, page: f"https://example.com/?q={search}",
+                0.1,
+                lambda data: data,
+                lambda result: result,
+            )
+        },
+    )
+    @patch("roboprop_client.views._search_external_library")
+    def test_search_deadline(self, mock_search_external_library):
+        def search_external_library(query, library):
+            if library == "slow":
+                time.sleep(1)
+            return []
+
+        mock_search_external_library.side_effect = search_external_library
+        start = time.monotonic()
+        search_results = _search_and_cache("lamp")
+        # The slow library doesn't hold up the others
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(search_results["unavailable"], ["slow"])
+        self.assertEqual(search_results["fuel"], [])
+
+    @patch("roboprop_client.views._search_external_library")
+    def test_search_normalized(self, mock_search_external_library):
+        mock_search_external_library.return_value = []
+        _search_and_cache("Red Chair")
+        _search_and_cache("  red   CHAIR ")
+        # Empty results are cached too
+        self.assertEqual(mock_search_external_library.call_count, 2)
+        mock_search_external_library.assert_any_call(
+            "https://fuel.gazebosim.org/1.0/models?q=red+chair&page=1", "fuel"
+        )
+        self.assertIsNotNone(cache.get("search_results_red+chair"))
+
+        # Query parameters arrive decoded, so they aren't decoded again
+        _search_and_cache("C++")
+        _search_and_cache("red+chair")
+        self.assertEqual(mock_search_external_library.call_count, 6)
+        self.assertIsNotNone(cache.get("search_results_c%2B%2B"))
+        mock_search_external_library.assert_any_call(
+            "https://fuel.gazebosim.org/1.0/models?q=c%2B%2B&page=1", "fuel"
+        )
+        mock_search_external_library.assert_any_call(
+            "https://fuel.gazebosim.org/1.0/models?q=red%2Bchair&page=1", "fuel"
+        )
+
+    @patch("roboprop_client.views._prefetch_next_page")
+    @patch("roboprop_client.views._is_valid_session", return_value=True)
+    @patch("roboprop_client.views._search_external_library")
+    def test_find_models_page(
+        self, mock_search_external_library, mock_is_valid_session, mock_prefetch
+    ):
+        mock_search_external_library.return_value = [
+            {"name": "Chair", "owner": "Me", "description": "A chair"}
+        ]
+        factory = RequestFactory()
+        request = factory.get(
+            "/find-models/page/", {"search": "chair", "library": "fuel", "page": 2}
+        )
+        request.session = {"session_token": "dummy_token"}
+        response = views.find_models_page(request)
+        data = json.loads(response.content)
+        self.assertEqual(data["models"][0]["name"], "Chair")
+        self.assertEqual(data["next_page"], 3)
+        # Only the requested library and page is searched
+        mock_search_external_library.assert_called_once_with(
+            "https://fuel.gazebosim.org/1.0/models?q=chair&page=2", "fuel"
+        )
+        mock_prefetch.assert_called_once_with("chair", 2, "fuel")
+
+        # Every page is cached separately
+        views.find_models_page(request)
+        mock_search_external_library.assert_called_once()
+        self.assertIsNotNone(cache.get("search_results_chair_fuel_2"))
+
+        # Past the last page
+        mock_search_external_library.return_value = []
+        request = factory.get(
+            "/find-models/page/", {"search": "chair", "library": "fuel", "page": 3}
+        )
+        request.session = {"session_token": "dummy_token"}
+        data = json.loads(views.find_models_page(request).content)
+        self.assertIsNone(data["next_page"])
+
+        request = factory.get("/find-models/page/", {"search": "chair"})
+        request.session = {"session_token": "dummy_token"}
+        self.assertEqual(views.find_models_page(request).status_code, 400)
+
+    @patch("roboprop_client.views._search_external_library")
+    def test_search_single_flight(self, mock_search_external_library):
+        def search_external_library(query, library):
+            time.sleep(0.3)
+            return [{"name": "Lamp"}]
+
+        mock_search_external_library.side_effect = search_external_library
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(_search_and_cache, ["lamp"] * 5))
+        # One search per library, shared by every request
+        self.assertEqual(mock_search_external_library.call_count, 2)
+        self.assertTrue(all(result["fuel"] == [{"name": "Lamp"}] for result in results))
+
+    @patch("roboprop_client.views._search_external_library")
+    def test_search_stale_while_revalidate(self, mock_search_external_library):
+        mock_search_external_library.return_value = [{"name": "New"}]
+        stale_results = {"fuel": [{"name": "Old"}], "blenderkit": [], "unavailable": []}
+        cache.set("search_results_sofa", stale_results)
+
+        # The outdated results are returned without waiting for the libraries
+        self.assertEqual(_search_and_cache("sofa"), stale_results)
+        for _ in range(50):
+            if cache.get("search_results_sofa")["fuel"] == [{"name": "New"}]:
+                break
+            time.sleep(0.1)
+        self.assertEqual(_search_and_cache("sofa")["fuel"], [{"name": "New"}])
+        self.assertEqual(mock_search_external_library.call_count, 2)
+
 
 class MyModelsUploadTestCase(TestCase):
     def setUp(self):
@@ -113,7 +460,7 @@ class MyModelsUploadTestCase(TestCase):
         self.url = reverse("mymodels")
         self.file = SimpleUploadedFile("KitchenSink.zip", b"file_content")
 
-    @patch("requests.post")
+    @patch("roboprop_client.fileserver.request")
     def test_file_upload_success(self, mock_post):
         mock_post.return_value.status_code = 201
         response = self.client.post(self.url, {"file": self.file})
@@ -122,7 +469,7 @@ class MyModelsUploadTestCase(TestCase):
         self.assertEqual(len(messages), 1)
         self.assertEqual(str(messages[0]), "Model uploaded successfully")
 
-    @patch("requests.post")
+    @patch("roboprop_client.fileserver.request")
     def test_file_upload_failure(self, mock_post):
         mock_post.return_value.status_code = 400
         response = self.client.post(self.url, {"file": self.file})
@@ -132,6 +479,83 @@ class MyModelsUploadTestCase(TestCase):
         self.assertEqual(str(messages[0]), "Failed to upload model")
 
 
+class FileserverTestCase(TestCase):
+    def test_session_reused(self):
+        session = fileserver.get_session()
+        self.assertIs(fileserver.get_session(), session)
+        adapter = session.get_adapter("https://example.com/")
+        # Uploads and logins aren't idempotent, so must never be retried
+        self.assertFalse(adapter.max_retries.is_retry("POST", 503))
+        self.assertTrue(adapter.max_retries.is_retry("GET", 503))
+
+    @patch("requests.Session.request")
+    def test_default_timeouts(self, mock_request):
+        utils.make_get_request("files/index.json")
+        mock_request.assert_called_once_with(
+            "GET",
+            ANY,
+            headers=ANY,
+            timeout=(
+                fileserver.FILESERVER_CONNECT_TIMEOUT,
+                fileserver.FILESERVER_READ_TIMEOUT,
+            ),
+        )
+
+    def test_multipart_file_stream(self):
+        file = BytesIO(b"model zip content")
+        body = fileserver.MultipartFileStream("files", "Chair.zip", file)
+        content = b""
+        # Read in small blocks, the way the body is sent
+        while chunk := body.read(4):
+            content += chunk
+        self.assertEqual(len(content), body.len)
+        boundary = body.content_type.split("boundary=")[1]
+        self.assertTrue(content.startswith(f"--{boundary}\r\n".encode()))
+        self.assertIn(b'name="files"; filename="Chair.zip"', content)
+        self.assertIn(b"\r\n\r\nmodel zip content\r\n", content)
+        self.assertTrue(content.endswith(f"--{boundary}--\r\n".encode()))
+
+
+class ChunkedUploadTestCase(TestCase):
+    def setUp(self):
+        upload_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_dir.cleanup)
+        settings = override_settings(CHUNKED_UPLOAD_DIR=upload_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_resumable_upload(self):
+        upload = chunked_upload.create_upload("models", "Chair.zip", 10)
+        upload_id = upload["upload_id"]
+        self.assertEqual(upload["offset"], 0)
+
+        self.assertEqual(chunked_upload.write_chunk(upload_id, 0, BytesIO(b"01234")), 5)
+        # e.g. a retried chunk that was already received
+        with self.assertRaises(chunked_upload.UploadOffsetError) as context:
+            chunked_upload.write_chunk(upload_id, 0, BytesIO(b"01234"))
+        self.assertEqual(context.exception.offset, 5)
+        # Can't finalize until everything has arrived
+        with self.assertRaises(chunked_upload.UploadOffsetError):
+            chunked_upload.get_completed_file(upload_id)
+        # Chunks can't go past the declared size
+        with self.assertRaises(ValueError):
+            chunked_upload.write_chunk(upload_id, 5, BytesIO(b"5678910"))
+        self.assertEqual(chunked_upload.get_upload(upload_id)["offset"], 5)
+
+        chunked_upload.write_chunk(upload_id, 5, BytesIO(b"56789"))
+        upload, path = chunked_upload.get_completed_file(upload_id)
+        self.assertEqual(upload["filename"], "Chair.zip")
+        self.assertEqual(path.read_bytes(), b"0123456789")
+
+        chunked_upload.delete_upload(upload_id)
+        with self.assertRaises(FileNotFoundError):
+            chunked_upload.get_upload(upload_id)
+
+    def test_invalid_upload_id(self):
+        with self.assertRaises(FileNotFoundError):
+            chunked_upload.get_upload("../../settings")
+
+
 # TODO: Fix from affecting index
 # class AddToMyModelsTestCase(TestCase):
 #     def setUp(self):
@@ -236,6 +660,682 @@ class MyModelsUploadTestCase(TestCase):
 #             )
 
 
+class DownloadCacheTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        patcher = patch.object(download_cache, "BLENDERKIT_CACHE_DIR", temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _download(self, content):
+        def download(path):
+            with open(path, "wb") as f:
+                f.write(content)
+
+        return Mock(side_effect=download)
+
+    def test_get_or_download(self):
+        download = self._download(b"blend file")
+        path = download_cache.get_or_download("asset1", download)
+        self.assertEqual(path.read_bytes(), b"blend file")
+        self.assertEqual(path.name, download_cache.file_sha256(path))
+
+        # Cached from now on
+        self.assertEqual(download_cache.get_or_download("asset1", download), path)
+        download.assert_called_once()
+
+        # Identical files are only stored once
+        other_path = download_cache.get_or_download(
+            "asset2", self._download(b"blend file")
+        )
+        self.assertEqual(other_path, path)
+
+        # Corrupted files are downloaded again
+        path.write_bytes(b"corrupted")
+        download_cache.get_or_download("asset1", download)
+        self.assertEqual(download.call_count, 2)
+        self.assertEqual(path.read_bytes(), b"blend file")
+
+    def test_cache_hit_is_not_hashed_again(self):
+        path = download_cache.get_or_download("asset1", self._download(b"blend"))
+        with patch.object(download_cache, "file_sha256") as mock_file_sha256:
+            self.assertEqual(
+                download_cache.get_or_download("asset1", self._download(b"blend")),
+                path,
+            )
+        mock_file_sha256.assert_not_called()
+
+    @patch.object(download_cache, "EVICTION_GRACE_PERIOD", 0)
+    def test_evict(self):
+        old_path = download_cache.get_or_download("old", self._download(b"a" * 10))
+        os.utime(old_path, (0, 0))
+        new_path = download_cache.get_or_download("new", self._download(b"b" * 10))
+
+        # Least recently used first
+        download_cache.evict(15)
+        self.assertFalse(old_path.exists())
+        self.assertTrue(new_path.exists())
+
+        download = self._download(b"a" * 10)
+        download_cache.get_or_download("old", download)
+        download.assert_called_once()
+
+
+class FakeRangeServer:
+    # Stands in for requests.get against a server that supports Range requests
+    def __init__(self, content, ranges=True, fail_from=None):
+        self.content = content
+        self.ranges = ranges
+        # Connections break after sending up to this offset
+        self.fail_from = fail_from
+        self.requested = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        range_header = (headers or {}).get("Range")
+        self.requested.append(range_header)
+        response = Mock()
+        response.__enter__ = Mock(return_value=response)
+        response.__exit__ = Mock(return_value=False)
+        response.raise_for_status = Mock()
+        if range_header and self.ranges:
+            start, end = map(int, range_header[len("bytes=") :].split("-"))
+            body = self.content[start : end + 1]
+            response.status_code = 206
+            response.headers = {
+                "Content-Range": f"bytes {start}-{end}/{len(self.content)}"
+            }
+        else:
+            start, body = 0, self.content
+            response.status_code = 200
+            response.headers = {"Content-Length": str(len(body))}
+        stream_body = BytesIO(body)
+        fail_from = self.fail_from
+
+        def read(size, decode_content=True):
+            position = start + stream_body.tell()
+            if fail_from is not None and position >= fail_from and body:
+                raise requests.ConnectionError("Connection reset")
+            if fail_from is not None and position < fail_from:
+                size = min(size, fail_from - position)
+            return stream_body.read(size)
+
+        response.raw.read = read
+        return response
+
+
+@patch.object(load_blenderkit, "MIN_SEGMENT_SIZE", 10)
+@patch.object(load_blenderkit, "DOWNLOAD_SEGMENTS", 4)
+@patch.object(load_blenderkit, "DOWNLOAD_RETRIES", 0)
+class DownloadLargeFileTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.destination = os.path.join(temp_dir.name, "temp.blend")
+        self.content = bytes(range(100))
+
+    def test_download_in_segments(self):
+        server = FakeRangeServer(self.content)
+        progress = Mock()
+        with patch.object(load_blenderkit.requests, "get", server.get):
+            load_blenderkit.download_large_file("url", self.destination, progress)
+        with open(self.destination, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        # One probe, then a range for each segment
+        self.assertEqual(
+            server.requested,
+            ["bytes=0-0", "bytes=0-24", "bytes=25-49", "bytes=50-74", "bytes=75-99"],
+        )
+        progress.assert_called_with(100, 100, ANY)
+        self.assertFalse(os.path.exists(self.destination + ".parts.json"))
+
+    def test_resume(self):
+        server = FakeRangeServer(self.content, fail_from=60)
+        with patch.object(load_blenderkit.requests, "get", server.get):
+            with self.assertRaises(requests.ConnectionError):
+                load_blenderkit.download_large_file("url", self.destination)
+        self.assertTrue(os.path.exists(self.destination + ".parts.json"))
+
+        server = FakeRangeServer(self.content)
+        with patch.object(load_blenderkit.requests, "get", server.get):
+            load_blenderkit.download_large_file("url", self.destination)
+        with open(self.destination, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        # Finished segments aren't downloaded again, the broken one carries on
+        self.assertEqual(server.requested, ["bytes=0-0", "bytes=60-74", "bytes=75-99"])
+
+    def test_download_without_ranges(self):
+        server = FakeRangeServer(self.content, ranges=False)
+        with patch.object(load_blenderkit.requests, "get", server.get):
+            load_blenderkit.download_large_file("url", self.destination)
+        with open(self.destination, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+
+class CollisionsTestCase(TestCase):
+    def setUp(self):
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        # An L shape, which a single convex hull fits badly
+        bpy.ops.mesh.primitive_cube_add(location=(0, 0, 0), scale=(2, 0.2, 0.2))
+        bpy.ops.mesh.primitive_cube_add(location=(-1.8, 0, 1), scale=(0.2, 0.2, 1))
+        bpy.ops.object.select_all(action="SELECT")
+        bpy.ops.object.join()
+        bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+        bpy.context.object.name = "L"
+        bpy.ops.mesh.primitive_uv_sphere_add(segments=128, ring_count=64)
+        self.addCleanup(bpy.ops.wm.read_factory_settings, use_empty=True)
+
+    def _mesh(self, name):
+        mesh = bpy.data.objects[name].data
+        mesh.calc_loop_triangles()
+        vertices = np.array([vertex.co for vertex in mesh.vertices])
+        triangles = np.array([triangle.vertices for triangle in mesh.loop_triangles])
+        return vertices, triangles
+
+    def _parts(self, vertices, triangles):
+        # The triangles of each separate hull
+        labels = np.arange(len(vertices))
+        for _ in range(len(vertices)):
+            for a, b in [(0, 1), (1, 2), (2, 0)]:
+                lowest = np.minimum(labels[triangles[:, a]], labels[triangles[:, b]])
+                labels[triangles[:, a]] = np.minimum(labels[triangles[:, a]], lowest)
+                labels[triangles[:, b]] = np.minimum(labels[triangles[:, b]], lowest)
+            if (labels[triangles] == labels[triangles[:, :1]]).all():
+                break
+        return [
+            triangles[labels[triangles[:, 0]] == label]
+            for label in np.unique(labels[triangles[:, 0]])
+        ]
+
+    def test_convex_hull(self):
+        collisions.create_collision_model("hull", triangle_budget=200)
+        vertices, triangles = self._mesh("Sphere")
+        self.assertLessEqual(len(triangles), 200)
+        # Every vertex is on the inside of every face
+        corners = vertices[triangles]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        offsets = np.einsum("ij,ij->i", normals, corners[:, 0])
+        self.assertTrue((vertices @ normals.T <= offsets + 1e-4).all())
+
+    def test_convex_decomposition(self):
+        collisions.create_collision_model("decomposition", triangle_budget=200)
+        vertices, triangles = self._mesh("L")
+        self.assertLessEqual(len(triangles), 200)
+        # Nothing left in the empty corner of the L
+        self.assertFalse(
+            ((vertices[:, 0] > -1) & (vertices[:, 2] > 0.6)).any(), vertices
+        )
+
+    def test_low_poly_table(self):
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        # A plane on two box legs, 26 triangles in all
+        bpy.ops.mesh.primitive_plane_add(location=(0, 0, 1))
+        for x in [-0.9, 0.9]:
+            bpy.ops.mesh.primitive_cube_add(location=(x, 0, 0.5), scale=(0.1, 1, 0.5))
+        bpy.ops.object.select_all(action="SELECT")
+        bpy.ops.object.join()
+        bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+        bpy.context.object.name = "Table"
+
+        collisions.create_collision_model("decomposition", triangle_budget=200)
+        vertices, triangles = self._mesh("Table")
+        self.assertLessEqual(len(triangles), 200)
+        # The space under the table top is outside of every part
+        self.assertGreaterEqual(len(self._parts(vertices, triangles)), 3)
+        for part in self._parts(vertices, triangles):
+            corners = vertices[part]
+            normals = np.cross(
+                corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+            )
+            offsets = np.einsum("ij,ij->i", normals, corners[:, 0])
+            self.assertFalse((normals @ [0, 0, 0.5] <= offsets + 1e-4).all())
+
+
+class OpenSceneTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.blend_file = self.temp_dir / "model" / "model.blend"
+        (self.temp_dir / "model" / "textures").mkdir(parents=True)
+        image_path = self.temp_dir / "model" / "textures" / "wood.png"
+        Image.new("RGB", (8, 8), "brown").save(image_path)
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        bpy.ops.mesh.primitive_cube_add()
+        material = bpy.data.materials.new("Wood")
+        material.use_nodes = True
+        texture = material.node_tree.nodes.new("ShaderNodeTexImage")
+        texture.image = bpy.data.images.load(str(image_path))
+        material.node_tree.links.new(
+            texture.outputs["Color"],
+            material.node_tree.nodes["Principled BSDF"].inputs["Base Color"],
+        )
+        bpy.context.object.data.materials.append(material)
+        bpy.ops.wm.save_as_mainfile(filepath=str(self.blend_file), relative_remap=True)
+        self.addCleanup(bpy.ops.wm.read_factory_settings, use_empty=True)
+
+    def test_relative_texture(self):
+        with open_scene(self.blend_file):
+            image = bpy.data.images["wood.png"]
+            self.assertTrue(image.filepath.startswith("//"))
+            self.assertTrue(Path(bpy.path.abspath(image.filepath)).is_file())
+
+        out_dir = self.temp_dir / "out"
+        export_model.export_sdf(out_dir, "Model", self.blend_file, formats=["fbx"])
+        # Copied next to the model
+        self.assertTrue((out_dir / "assets" / "visual.fbm" / "wood.png").is_file())
+
+
+class TexturesTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.blend_file = os.path.join(temp_dir.name, "model.blend")
+        image_path = os.path.join(temp_dir.name, "texture.png")
+        Image.new("RGB", (64, 32), "red").save(image_path)
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        # The same texture, packed twice
+        for name in ["first", "second"]:
+            image = bpy.data.images.load(image_path, check_existing=False)
+            image.name = name
+            image.pack()
+            image.use_fake_user = True
+        bpy.ops.wm.save_as_mainfile(filepath=self.blend_file)
+        os.remove(image_path)
+        self.addCleanup(bpy.ops.wm.read_factory_settings, use_empty=True)
+
+    def test_optimize_textures(self):
+        with open_scene(self.blend_file) as work_dir:
+            textures.optimize_textures(work_dir, max_size=16)
+            images = [image for image in bpy.data.images if image.source == "FILE"]
+            self.assertEqual(len(images), 1)
+            self.assertEqual(tuple(images[0].size), (16, 8))
+            path = bpy.path.abspath(images[0].filepath)
+            self.assertTrue(path.startswith(str(work_dir)))
+            self.assertEqual(Image.open(path).size, (16, 8))
+        # Nothing was unpacked next to the blend file
+        self.assertEqual(os.listdir(os.path.dirname(self.blend_file)), ["model.blend"])
+
+
+class ExportGlbTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.output = Path(temp_dir.name) / "collision.glb"
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        bpy.ops.mesh.primitive_cube_add()
+        bpy.context.object.data.materials.append(bpy.data.materials.new("paint"))
+        self.addCleanup(bpy.ops.wm.read_factory_settings, use_empty=True)
+
+    @patch.object(export_glb, "GLTFPACK", "missing-gltfpack")
+    def test_export_collision(self):
+        # Exported uncompressed when the compressor isn't installed
+        export_glb.export_glb_collision(self.output, compression="meshopt")
+        self.assertIsNone(export_glb.get_glb_compression(self.output))
+        with open(self.output, "rb") as f:
+            f.seek(12)
+            json_length = int.from_bytes(f.read(4), "little")
+            f.seek(20)
+            gltf = json.loads(f.read(json_length))
+        self.assertNotIn("materials", gltf)
+        self.assertIsNotNone(export_glb.measure_decode_time(self.output))
+
+    def test_export_options(self):
+        glb_config = {"visual": "assets/visual.glb", "compression": "draco"}
+        self.assertEqual(
+            export_model._get_export_options(glb_config), {"compression": "draco"}
+        )
+        fbx_config = {"visual": "assets/visual.fbx", "compression": "draco"}
+        with self.assertRaises(ValueError):
+            export_model._get_export_options(fbx_config)
+        self.assertEqual(export_model._get_export_options({"visual": "visual.fbx"}), {})
+
+
+class ConversionCacheTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        patcher = patch.object(
+            download_cache, "BLENDERKIT_CACHE_DIR", str(self.temp_dir / "cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blend_file = self.temp_dir / "model.blend"
+        self.blend_file.write_bytes(b"blend file")
+
+    @patch.object(export_model, "export_sdf")
+    def test_export_sdf_cached(self, mock_export_sdf):
+        def export_sdf(out_dir, model_name, blend_file_path):
+            (out_dir / "model.sdf").write_text(model_name)
+
+        mock_export_sdf.side_effect = export_sdf
+        key = export_model.export_sdf_cached(
+            self.temp_dir / "first", "Chair", self.blend_file
+        )
+
+        # Converted once, then taken from the cache
+        self.assertEqual(
+            export_model.export_sdf_cached(
+                self.temp_dir / "second", "Chair", self.blend_file
+            ),
+            key,
+        )
+        mock_export_sdf.assert_called_once()
+        self.assertEqual((self.temp_dir / "second" / "model.sdf").read_text(), "Chair")
+
+        # Converted again once the exporters change
+        blend_sha256 = download_cache.file_sha256(self.blend_file)
+        self.assertEqual(export_model.get_conversion_key(blend_sha256, "Chair"), key)
+        with patch.object(export_model, "EXPORTER_VERSION", 0):
+            self.assertNotEqual(
+                export_model.get_conversion_key(blend_sha256, "Chair"), key
+            )
+
+
+class UpdateModelsFromBlenderkitTestCase(TestCase):
+    @patch.object(add_blenderkit_model_to_my_models_task, "delay")
+    @patch("roboprop_client.tasks.get_blenderkit_assets")
+    @patch("roboprop_client.tasks.get_index")
+    def test_only_changed_models_are_queued(
+        self, mock_get_index, mock_get_blenderkit_assets, mock_delay
+    ):
+        settings_key = export_model.get_export_settings_key()
+        revision = {"id": "v1", "revision": 1, "updated": "2024-01-01"}
+        mock_get_index.return_value = {
+            "Unchanged": {
+                "assetBaseId": "a",
+                "blenderkitRevision": revision,
+                "exportSettingsKey": settings_key,
+            },
+            "NewRevision": {
+                "assetBaseId": "b",
+                "blenderkitRevision": revision,
+                "exportSettingsKey": settings_key,
+            },
+            "OldSettings": {
+                "assetBaseId": "c",
+                "blenderkitRevision": revision,
+                "exportSettingsKey": "old",
+            },
+            "Missing": {"assetBaseId": "d"},
+            "NoThumbnail": {"assetBaseId": "e"},
+            "Uploaded": {"tags": []},
+        }
+        mock_get_blenderkit_assets.return_value = {
+            "a": {**revision, "thumbnailMiddleUrl": "a.png"},
+            "b": {**revision, "revision": 2, "thumbnailMiddleUrl": "b.png"},
+            "c": {**revision, "thumbnailMiddleUrl": "c.png"},
+            "d": None,
+            "e": {**revision},
+        }
+        mock_delay.side_effect = lambda name, *args: Mock(id=f"{name}_task")
+
+        summary = update_models_from_blenderkit_task()
+
+        mock_get_blenderkit_assets.assert_called_once_with(["a", "b", "c", "d", "e"])
+        self.assertEqual(
+            summary,
+            {
+                "queued": [
+                    {"name": "NewRevision", "task_id": "NewRevision_task"},
+                    {"name": "OldSettings", "task_id": "OldSettings_task"},
+                ],
+                "skipped": ["Unchanged"],
+                "failed": ["Missing", "NoThumbnail"],
+            },
+        )
+        mock_delay.assert_any_call(
+            "NewRevision", "b", "b.png", {**revision, "revision": 2}
+        )
+
+    @patch("roboprop_client.utils.requests.get")
+    def test_get_blenderkit_assets(self, mock_get):
+        def get(url, timeout):
+            if url.endswith(":broken"):
+                raise requests.ConnectionError()
+            response = Mock()
+            response.json.return_value = {"results": [{"id": url[-1]}]}
+            return response
+
+        mock_get.side_effect = get
+        self.assertEqual(
+            utils.get_blenderkit_assets(["a", "b", "a", "broken"]),
+            {"a": {"id": "a"}, "b": {"id": "b"}, "broken": None},
+        )
+        # Each asset is only looked up once
+        self.assertEqual(mock_get.call_count, 3)
+
+
+class ConversionPoolTestCase(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+    def test_convert(self):
+        blend_file = os.path.join(self.temp_dir, "cube.blend")
+        bpy.ops.wm.read_factory_settings(use_empty=True)
+        bpy.ops.mesh.primitive_cube_add()
+        bpy.ops.wm.save_as_mainfile(filepath=blend_file)
+        broken_file = os.path.join(self.temp_dir, "broken.blend")
+        with open(broken_file, "w") as f:
+            f.write("not a blend file")
+
+        jobs = [
+            conversion_pool.ConversionJob(
+                blend_file=path,
+                out_dir=os.path.join(self.temp_dir, name),
+                model_name=name,
+                formats=["glb"],
+            )
+            for name, path in [
+                ("Cube", blend_file),
+                ("Broken", broken_file),
+                ("Cube2", blend_file),
+            ]
+        ]
+        results = {
+            result.job.model_name: result
+            for result in conversion_pool.convert(jobs, workers=2)
+        }
+
+        self.assertEqual(len(results), 3)
+        # A failing job doesn't affect the others
+        self.assertFalse(results["Broken"].ok)
+        for name in ["Cube", "Cube2"]:
+            self.assertTrue(results[name].ok, results[name].error)
+            out_dir = os.path.join(self.temp_dir, name)
+            self.assertTrue(os.path.exists(os.path.join(out_dir, "glft-model.sdf")))
+            self.assertFalse(os.path.exists(os.path.join(out_dir, "model.sdf")))
+
+
+class ThumbnailsTestCase(TestCase):
+    def test_create_variant(self):
+        image = Image.new("RGBA", (2000, 1000), (255, 0, 0, 128))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="PNG")
+
+        variant = thumbnails.create_variant(image_bytes.getvalue(), "gallery")
+        with Image.open(BytesIO(variant)) as variant_image:
+            self.assertEqual(variant_image.format, "WEBP")
+            # Aspect ratio is kept
+            self.assertEqual(variant_image.size, (320, 160))
+
+        variant = thumbnails.create_variant(image_bytes.getvalue(), "rekognition")
+        with Image.open(BytesIO(variant)) as variant_image:
+            self.assertEqual(variant_image.format, "JPEG")
+
+    def test_variant_path(self):
+        self.assertEqual(
+            thumbnails.variant_path("models/Chair/thumbnails/01.png", "gallery"),
+            "models/Chair/thumbnails/gallery/01.webp",
+        )
+
+
+class RekognitionTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = boto3.client(
+            "rekognition",
+            region_name="eu-west-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        patcher = patch(
+            "roboprop_client.rekognition.get_client", return_value=self.client
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _label(self, name, category, parent=None, color=None):
+        return {
+            "Name": name,
+            "Categories": [{"Name": category}],
+            "Parents": [{"Name": parent}] if parent else [],
+            "Instances": (
+                [{"DominantColors": [{"SimplifiedColor": color}]}] if color else []
+            ),
+        }
+
+    def test_get_suggested_tags(self):
+        labels = [
+            self._label("Chair", "Furniture", parent="Seat", color="red"),
+            self._label("Lamp", "Lighting"),
+        ]
+        self.stubber.add_response("detect_labels", {"Labels": labels})
+        self.stubber.add_response("detect_labels", {"Labels": labels})
+
+        tags, categories, colors = rekognition.get_suggested_tags(
+            [b"front", b"front", b"back"]
+        )
+        # Duplicate thumbnails are only sent once
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(sorted(tags), ["Chair", "Lamp"])
+        self.assertEqual(sorted(categories), ["Furniture", "Lighting", "Seat"])
+        self.assertEqual(colors, ["red"])
+
+        # Repeat imports are answered from the cache
+        self.assertEqual(
+            sorted(rekognition.get_suggested_tags([b"back", b"back"])[0]),
+            ["Chair", "Lamp"],
+        )
+
+        # Labels found in a single thumbnail are dropped as outliers
+        self.stubber.add_response("detect_labels", {"Labels": labels})
+        self.assertEqual(rekognition.get_suggested_tags([b"side"]), ([], [], []))
+
+    def test_aggregate_labels(self):
+        chair = dict(self._label("Chair", "Furniture", color="red"), Confidence=99)
+        sofa = dict(self._label("Sofa", "Furniture", color="grey"), Confidence=95)
+        table = dict(self._label("Table", "Furniture"), Confidence=91)
+        tags, categories, colors = rekognition.aggregate_labels(
+            [[chair, sofa, table], [sofa, table], [sofa, chair]]
+        )
+        # Ranked by how often, and how confidently, each was seen
+        self.assertEqual(tags, ["Sofa", "Chair", "Table"])
+        self.assertEqual(categories, ["Furniture"])
+        self.assertEqual(colors, ["grey", "red"])
+
+    def test_get_suggested_tags_error(self):
+        self.stubber.add_client_error("detect_labels", "InvalidImageFormatException")
+        self.assertEqual(rekognition.get_suggested_tags([b"broken"]), ([], [], []))
+
+
+class CatalogueTestCase(TestCase):
+    def setUp(self):
+        cache.delete(catalogue.CATALOGUE_VERSION_KEY)
+        self.index = {
+            "RedChair": {
+                "description": "A wooden chair",
+                "tags": ["chair", "wood"],
+                "categories": ["Furniture"],
+                "colors": ["Red"],
+                "source": "Fuel",
+            },
+            "KitchenTable": {
+                "description": "A table with a red chair",
+                "tags": ["table"],
+                "categories": ["Furniture"],
+                "colors": ["Brown"],
+                "source": "Upload",
+            },
+            "Tree": {"description": "An oak tree", "source": "Blenderkit"},
+        }
+        self.catalogue = catalogue.Catalogue(self.index)
+
+    def test_tokenize(self):
+        self.assertEqual(
+            catalogue.tokenize("KitchenSink_2 large"), ["kitchen", "sink", "2", "large"]
+        )
+
+    def test_search(self):
+        results = self.catalogue.search("red chair")
+        self.assertEqual(results["total"], 2)
+        # A match in the name ranks higher than one in the description
+        self.assertEqual(
+            [result["name"] for result in results["results"]],
+            ["RedChair", "KitchenTable"],
+        )
+        self.assertIn(("furniture", 2), results["facets"]["category"])
+
+        # Prefixes match too
+        self.assertEqual(self.catalogue.search("chai")["total"], 2)
+        self.assertEqual(self.catalogue.search("red oak")["total"], 0)
+
+    def test_search_filters(self):
+        results = self.catalogue.search("chair", {"source": ["upload"]})
+        self.assertEqual([r["name"] for r in results["results"]], ["KitchenTable"])
+
+        results = self.catalogue.search("", {"category": ["Furniture"]}, limit=1)
+        self.assertEqual(results["total"], 2)
+        self.assertEqual(len(results["results"]), 1)
+
+    def test_upsert_and_delete(self):
+        self.catalogue.upsert("Tree", {"description": "A red maple", "tags": ["tree"]})
+        self.assertEqual(self.catalogue.search("oak")["total"], 0)
+        self.assertEqual(self.catalogue.search("maple")["total"], 1)
+
+        self.catalogue.delete("RedChair")
+        self.assertEqual(self.catalogue.search("wooden")["total"], 0)
+        self.assertNotIn("wood", dict(self.catalogue.search()["facets"]["tag"]))
+
+    def test_index_changed(self):
+        load_index = Mock(return_value=self.index)
+        catalogue.search(load_index, "tree")
+        catalogue.index_changed("Lamp", {"description": "A desk lamp"})
+        self.assertEqual(catalogue.search(load_index, "lamp")["total"], 1)
+        # Applied in place rather than reloading index.json
+        load_index.assert_called_once()
+
+        # Another process changed the index
+        cache.set(catalogue.CATALOGUE_VERSION_KEY, "elsewhere")
+        self.assertEqual(catalogue.search(load_index, "lamp")["total"], 0)
+        self.assertEqual(load_index.call_count, 2)
+
+    def test_max_age(self):
+        load_index = Mock(return_value=self.index)
+        catalogue.search(load_index, "tree")
+        # Changed without going through update_index, so the version is the same
+        load_index.return_value = {"Lamp": {"description": "A desk lamp"}}
+        self.assertEqual(catalogue.search(load_index, "lamp")["total"], 0)
+        with patch.object(catalogue, "CATALOGUE_MAX_AGE", 0):
+            self.assertEqual(catalogue.search(load_index, "lamp")["total"], 1)
+        self.assertEqual(load_index.call_count, 2)
+
+    def test_search_while_loading(self):
+        load_index = Mock(return_value=self.index)
+        catalogue.search(load_index, "tree")
+        cache.set(catalogue.CATALOGUE_VERSION_KEY, "elsewhere")
+        # Another request is fetching index.json, the loaded catalogue is used
+        with catalogue._load_lock:
+            self.assertEqual(catalogue.search(load_index, "tree")["total"], 1)
+        load_index.assert_called_once()
+
+
 """
 At present, flatten_dict is designed to be used with
 model.config files, i.e for metadata, where a huge amount of nesting / 
@@ -265,6 +1365,57 @@ class UtilsTestCase(TestCase):
             },
         )
 
+    @patch("roboprop_client.utils._get_lock_client")
+    @patch("roboprop_client.utils.make_put_request")
+    @patch("roboprop_client.utils.make_get_request")
+    def test_update_index(
+        self, mock_make_get_request, mock_make_put_request, mock_get_lock_client
+    ):
+        # Someone else added a model since this request started
+        mock_make_get_request.return_value = Mock(
+            status_code=200, content=json.dumps({"Other": {"tags": []}}).encode()
+        )
+        utils.update_index("Chair", {"tags": ["chair"]}, "Upload")
+
+        index = json.loads(mock_make_put_request.call_args.kwargs["data"])
+        self.assertEqual(set(index), {"Other", "Chair"})
+        self.assertEqual(index["Chair"]["tags"], ["chair"])
+        self.assertEqual(index["Chair"]["source"], "Upload")
+        lock = mock_get_lock_client.return_value.lock.return_value
+        lock.release.assert_called_once()
+
+    @patch("roboprop_client.utils._get_lock_client")
+    @patch("roboprop_client.utils.make_put_request")
+    @patch("roboprop_client.utils.make_get_request")
+    def test_update_index_unreadable(
+        self, mock_make_get_request, mock_make_put_request, mock_get_lock_client
+    ):
+        mock_make_get_request.return_value = Mock(status_code=500)
+        response = utils.update_index("Chair", {"tags": ["chair"]}, "Upload")
+        self.assertEqual(response.status_code, 500)
+        mock_make_put_request.assert_not_called()
+
+    @patch("roboprop_client.utils._get_lock_client")
+    @patch("roboprop_client.utils.make_put_request")
+    @patch("roboprop_client.utils.make_get_request")
+    def test_update_index_lock_expired(
+        self, mock_make_get_request, mock_make_put_request, mock_get_lock_client
+    ):
+        mock_make_get_request.return_value = Mock(status_code=404)
+        lock = mock_get_lock_client.return_value.lock.return_value
+        # Taken by someone else by the time it's released, which is left alone
+        lock.release.side_effect = redis.exceptions.LockNotOwnedError()
+        utils.update_index("Chair", {"tags": ["chair"]}, "Upload")
+        mock_make_put_request.assert_called_once()
+
+    @patch("roboprop_client.utils._get_lock_client")
+    def test_update_index_locked(self, mock_get_lock_client):
+        lock = mock_get_lock_client.return_value.lock.return_value
+        lock.acquire.return_value = False
+        with self.assertRaises(TimeoutError):
+            utils.update_index("Chair", {"tags": ["chair"]}, "Upload")
+        lock.release.assert_not_called()
+
     def test_create_list_from_string(self):
         # Test with non-empty string
         assert utils.create_list_from_string("  apple,  banana,  cherry pie ") == [
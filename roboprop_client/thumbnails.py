@@ -0,0 +1,45 @@
+import os
+from io import BytesIO
+from PIL import Image
+
+# Resized copies of every thumbnail are stored in thumbnails/<variant>/ next to
+# the originals, so each page can download the smallest image it needs.
+THUMBNAIL_VARIANTS = {
+    "gallery": {"size": 320, "format": "WEBP", "extension": ".webp"},
+    "detail": {"size": 768, "format": "WEBP", "extension": ".webp"},
+    # Rekognition only accepts JPEG and PNG images
+    "rekognition": {"size": 1024, "format": "JPEG", "extension": ".jpg"},
+}
+VARIANT_QUALITY = 80
+
+
+def variant_path(path, variant):
+    # e.g. models/Chair/thumbnails/01.png -> models/Chair/thumbnails/gallery/01.webp
+    folder, filename = os.path.split(path)
+    stem = os.path.splitext(filename)[0]
+    extension = THUMBNAIL_VARIANTS[variant]["extension"]
+    return f"{folder}/{variant}/{stem}{extension}"
+
+
+def create_variant(image_bytes, variant):
+    config = THUMBNAIL_VARIANTS[variant]
+    with Image.open(BytesIO(image_bytes)) as image:
+        # JPEG has no alpha channel, WebP keeps it
+        mode = "RGB" if config["format"] == "JPEG" else "RGBA"
+        image = image.convert(mode)
+        # Keeps the aspect ratio, and never scales up
+        image.thumbnail((config["size"], config["size"]), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format=config["format"], quality=VARIANT_QUALITY)
+    return output.getvalue()
+
+
+def add_local_thumbnail_variants(thumbnail_path):
+    # For models that are converted locally, before they are zipped and uploaded
+    with open(thumbnail_path, "rb") as thumbnail_file:
+        image_bytes = thumbnail_file.read()
+    for variant in THUMBNAIL_VARIANTS:
+        path = variant_path(str(thumbnail_path), variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as variant_file:
+            variant_file.write(create_variant(image_bytes, variant))
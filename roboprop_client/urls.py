@@ -5,12 +5,21 @@ from . import views
 urlpatterns = [
     path("", views.home, name="home"),
     path("find-models/", views.find_models, name="find-models"),
+    path("find-models/page/", views.find_models_page, name="find-models-page"),
     path("add-to-my-models/", views.add_to_my_models, name="add_to_my_models"),
+    path("catalogue/search/", views.search_catalogue, name="search_catalogue"),
     path("login", views.login, name="login"),
     path("logout", views.logout, name="logout"),
     path("mymodels/", views.mymodels, name="mymodels"),
     path("mymodels/<str:name>/", views.mymodel_detail, name="mymodel_detail"),
     path("myrobots/", views.myrobots, name="myrobots"),
+    path("uploads/", views.create_upload, name="create_upload"),
+    path("uploads/<str:upload_id>/", views.upload_chunk, name="upload_chunk"),
+    path(
+        "uploads/<str:upload_id>/finalize/",
+        views.finalize_upload,
+        name="finalize_upload",
+    ),
     path("myrobots/<str:name>/", views.myrobot_detail, name="myrobot_detail"),
     path("add-metadata/<str:name>/", views.add_metadata, name="add_metadata"),
     path(
@@ -19,4 +28,9 @@ urlpatterns = [
         name="update_models_from_blenderkit",
     ),
     path("task-status/<str:task_id>/", views.task_status, name="task_status"),
+    path(
+        "thumbnails/<str:asset_type>/<str:name>/<int:index>/",
+        views.thumbnail,
+        name="thumbnail",
+    ),
 ]
@@ -1,39 +1,58 @@
 import requests
+import redis
 import os
+import hashlib
+import mimetypes
 import shutil
 import zipfile
 import urllib.parse
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.http import parse_http_date_safe
+from roboprop_client.export_model import get_export_settings_key
 from roboprop_client.load_blenderkit import load_blenderkit_model
+import roboprop_client.asset_cache as asset_cache
+import roboprop_client.catalogue as catalogue
+import roboprop_client.fileserver as fileserver
+import roboprop_client.thumbnails as thumbnails
 
 FILESERVER_API_KEY = "X-DreamFactory-API-Key"
 FILESERVER_API_KEY_VALUE = os.getenv("FILESERVER_API_KEY", "")
 FILESERVER_URL = os.getenv("FILESERVER_URL", "")
 BLENDERKIT_PRO_API_KEY = os.getenv("BLENDERKIT_PRO_API_KEY", "")
 
+THUMBNAIL_FETCH_TIMEOUT = float(os.getenv("THUMBNAIL_FETCH_TIMEOUT", 10))
+BLENDERKIT_LOOKUP_WORKERS = 8
+BLENDERKIT_LOOKUP_TIMEOUT = 10
+# Fields of a BlenderKit asset that change when a new version is uploaded
+BLENDERKIT_REVISION_FIELDS = ["id", "revision", "updated"]
+
+INDEX_LOCK_KEY = "index_json_lock"
+INDEX_LOCK_TIMEOUT = 60  # So a crashed worker can't hold the lock forever
+INDEX_LOCK_WAIT = 30
+_lock_client = None
+
 
 # FILESERVER REQUESTS
-def make_get_request(url, session_token=None):
-    url = FILESERVER_URL + url
+def _headers(session_token=None):
+    headers = {FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE}
     if session_token:
-        return requests.get(
-            url,
-            headers={
-                FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE,
-                "X-DreamFactory-Session-Token": session_token,
-            },
-        )
-    else:
-        return requests.get(url, headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE})
+        headers["X-DreamFactory-Session-Token"] = session_token
+    return headers
 
 
-def make_put_request(url, data):
+def make_get_request(url, session_token=None, timeout=None):
     url = FILESERVER_URL + url
-    response = requests.put(
-        url,
-        data=data,
-        headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE},
+    return fileserver.request(
+        "GET", url, headers=_headers(session_token), timeout=timeout
     )
+
+
+def make_put_request(url, data):
+    url = FILESERVER_URL + url
+    response = fileserver.request("PUT", url, data=data, headers=_headers())
     return response
 
 
@@ -43,48 +62,37 @@ def make_post_request(
     url = FILESERVER_URL + url + parameters
     if files:
         # At present all files are uploaded as a zip file.
-        response = requests.post(
-            url,
-            files=files,
-            headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE},
-            timeout=540,
+        response = fileserver.request(
+            "POST", url, files=files, headers=_headers(), timeout=540
         )
     elif json:
-        response = requests.post(
-            url,
-            headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE},
-            json=json,
-        )
+        response = fileserver.request("POST", url, headers=_headers(), json=json)
     else:
-        response = requests.post(
-            url,
-            headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE},
-        )
+        response = fileserver.request("POST", url, headers=_headers())
     return response
 
 
+def make_upload_request(url, filename, file, parameters="?extract=true&clean=true"):
+    # Streams the file to the file server rather than reading it into memory
+    url = FILESERVER_URL + url + parameters
+    body = fileserver.MultipartFileStream("files", filename, file)
+    headers = _headers()
+    headers["Content-Type"] = body.content_type
+    return fileserver.request("POST", url, data=body, headers=headers, timeout=540)
+
+
 def make_delete_request(url, session_token=None):
     url = FILESERVER_URL + url
-    if session_token:
-        return requests.delete(
-            url,
-            headers={
-                FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE,
-                "X-DreamFactory-Session-Token": session_token,
-            },
-        )
-    else:
-        return requests.delete(
-            url, headers={FILESERVER_API_KEY: FILESERVER_API_KEY_VALUE}
-        )
+    return fileserver.request("DELETE", url, headers=_headers(session_token))
 
 
 def upload_file(file, asset_type):
-    files = {"files": (file.name, file.read())}
     asset_name = os.path.splitext(file.name)[0]
     # Creates the folder as well as unzipping the model into it.
     url = f"{asset_type}/{asset_name}/"
-    response = make_post_request(url, files=files)
+    response = make_upload_request(url, file.name, file)
+    asset_cache.invalidate_thumbnails(asset_type, asset_name)
+    asset_cache.invalidate_asset_listing(asset_type)
     return response
 
 
@@ -149,10 +157,130 @@ def add_blenderkit_thumbnail(thumbnail, folder_name):
     )
     with open(thumbnail_path, "wb") as thumbnail_file:
         thumbnail_file.write(thumbnail_response.content)
+    thumbnails.add_local_thumbnail_variants(thumbnail_path)
+
+
+def list_thumbnails(asset_type, asset_name):
+    listing = asset_cache.get_thumbnail_listing(asset_type, asset_name)
+    if listing is not None:
+        return listing
+    url = f"files/{asset_type}/{asset_name}/thumbnails/"
+    response = make_get_request(url, timeout=THUMBNAIL_FETCH_TIMEOUT)
+    if response.status_code == 404:
+        resource = []
+    elif response.status_code == 200:
+        resource = response.json()["resource"]
+    else:
+        # Don't cache file server errors
+        return {"paths": [], "variants": []}
+    listing = {
+        "paths": [data["path"] for data in resource if data["type"] == "file"],
+        # Resized variants are kept in sub folders, see thumbnails.py
+        "variants": [data["name"] for data in resource if data["type"] == "folder"],
+    }
+    asset_cache.set_thumbnail_listing(asset_type, asset_name, listing)
+    return listing
+
+
+def download_thumbnail(asset_type, asset_name, path):
+    image = asset_cache.get_thumbnail(asset_type, asset_name, path)
+    if image is None:
+        response = make_get_request(f"files/{path}", timeout=THUMBNAIL_FETCH_TIMEOUT)
+        if response.status_code != 200:
+            return None
+        image = {
+            "content": response.content,
+            "content_type": response.headers.get("Content-Type")
+            or mimetypes.guess_type(path)[0]
+            or "application/octet-stream",
+            "etag": hashlib.sha1(response.content).hexdigest(),
+            "last_modified": parse_http_date_safe(
+                response.headers.get("Last-Modified", "")
+            ),
+        }
+        asset_cache.set_thumbnail(asset_type, asset_name, path, image)
+    return image
+
+
+def download_thumbnail_variant(asset_type, asset_name, listing, index, variant=None):
+    path = listing["paths"][index]
+    if variant in listing["variants"]:
+        image = download_thumbnail(
+            asset_type, asset_name, thumbnails.variant_path(path, variant)
+        )
+        if image is not None:
+            return image
+    # No resized variant (yet), fall back to the original
+    return download_thumbnail(asset_type, asset_name, path)
+
+
+def get_thumbnail_images(asset_type, asset_name, variant=None):
+    listing = list_thumbnails(asset_type, asset_name)
+    images = []
+    for index in range(len(listing["paths"])):
+        image = download_thumbnail_variant(
+            asset_type, asset_name, listing, index, variant
+        )
+        if image is not None:
+            images.append(image["content"])
+    return images
+
+
+def add_thumbnail_variants(asset_type, asset_name, force=False):
+    # For assets already on the file server, i.e uploads, Fuel imports and backfills
+    url = f"files/{asset_type}/{asset_name}/thumbnails/"
+    response = make_get_request(url)
+    if response.status_code != 200:
+        return []
+    resource = response.json()["resource"]
+    existing = [data["name"] for data in resource if data["type"] == "folder"]
+    variants = [
+        variant
+        for variant in thumbnails.THUMBNAIL_VARIANTS
+        if force or variant not in existing
+    ]
+    paths = [data["path"] for data in resource if data["type"] == "file"]
+    if not variants or not paths:
+        return []
+
+    files = {variant: [] for variant in variants}
+    for path in paths:
+        response = make_get_request(f"files/{path}")
+        if response.status_code != 200:
+            continue
+        for variant in variants:
+            filename = os.path.basename(thumbnails.variant_path(path, variant))
+            image = thumbnails.create_variant(response.content, variant)
+            files[variant].append(("files", (filename, image)))
+
+    created = []
+    for variant, variant_files in files.items():
+        if not variant_files:
+            continue
+        response = make_post_request(
+            f"{url}{variant}/", parameters="?check_exist=false", files=variant_files
+        )
+        if response.status_code == 201:
+            created.append(variant)
+    # So the new variants show up in the cached thumbnail listing
+    asset_cache.invalidate_thumbnails(asset_type, asset_name)
+    return created
 
 
-def add_blenderkit_model_to_my_models(folder_name, asset_base_id, thumbnail):
-    load_blenderkit_model(asset_base_id, "models", folder_name)
+def add_blenderkit_model_to_my_models(
+    folder_name, asset_base_id, thumbnail, progress=None
+):
+    """
+    Returns the upload response and the model's conversion key, or None as
+    the response if the model uploaded before is still up to date
+    """
+    index = get_index() or {}
+    previous_conversion_key = index.get(folder_name, {}).get("conversionKey")
+    conversion_key = load_blenderkit_model(
+        asset_base_id, "models", folder_name, progress, previous_conversion_key
+    )
+    if conversion_key is None:
+        return None, previous_conversion_key
 
     add_blenderkit_thumbnail(thumbnail, folder_name)
     zip_filename, zip_path = create_zip_file(folder_name)
@@ -162,20 +290,26 @@ def add_blenderkit_model_to_my_models(folder_name, asset_base_id, thumbnail):
     try:
         # Upload the ZIP file in a POST request
         with open(zip_path, "rb") as zip_file:
-            files = {"files": (zip_filename, zip_file)}
-            response = make_post_request(url, files=files)
+            response = make_upload_request(url, zip_filename, zip_file)
+        asset_cache.invalidate_thumbnails("models", asset_name)
+        asset_cache.invalidate_asset_listing("models")
     finally: # Clean up, even if post request fails
         delete_folders(["models", "textures"], asset_name)
         if os.path.exists(zip_path):
             os.remove(zip_path)
 
-    return response
+    return response, conversion_key
+
+
+def get_blenderkit_revision(asset):
+    return {field: asset.get(field) for field in BLENDERKIT_REVISION_FIELDS}
 
 
 def get_blenderkit_metadata(folder_name):
     tags = []
     categories = []
     description = []
+    revision = None
     url = f"files/models/{folder_name}/blenderkit_meta.json"
     response = make_get_request(url)
     if response.status_code == 200:
@@ -185,27 +319,115 @@ def get_blenderkit_metadata(folder_name):
         # is a list for consistency
         categories = [metadata.get("category", "").strip()]
         description = metadata.get("description", "")
-    return tags, categories, description
+        revision = get_blenderkit_revision(metadata)
+    return tags, categories, description, revision
+
+
+def _get_blenderkit_asset(asset_base_id):
+    try:
+        response = requests.get(
+            f"https://www.blenderkit.com/api/v1/search/?query=asset_base_id:{asset_base_id}",
+            timeout=BLENDERKIT_LOOKUP_TIMEOUT,
+        )
+        response.raise_for_status()
+        results = response.json()["results"]
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+    return results[0] if results else None
+
+
+def get_blenderkit_assets(asset_base_ids):
+    """
+    Looks up the current BlenderKit metadata of every asset, concurrently.
+    Returns {asset_base_id: metadata, or None if the lookup failed}
+    """
+    asset_base_ids = list(dict.fromkeys(asset_base_ids))
+    with ThreadPoolExecutor(max_workers=BLENDERKIT_LOOKUP_WORKERS) as executor:
+        return dict(
+            zip(asset_base_ids, executor.map(_get_blenderkit_asset, asset_base_ids))
+        )
+
+
+def _get_lock_client():
+    global _lock_client
+    if _lock_client is None:
+        _lock_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+    return _lock_client
 
 
-def update_index(model_name, model_metadata, model_source, index):
+@contextmanager
+def _index_lock():
+    # A lock in Celery's Redis, which every process shares, so that web and
+    # Celery workers update index.json one at a time instead of overwriting
+    # each other. redis-py only releases the lock if it is still ours.
+    lock = _get_lock_client().lock(
+        INDEX_LOCK_KEY, timeout=INDEX_LOCK_TIMEOUT, blocking_timeout=INDEX_LOCK_WAIT
+    )
+    if not lock.acquire():
+        raise TimeoutError("Timed out waiting for the index.json lock")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            # Expired, and may have been taken by someone else meanwhile
+            pass
+
+
+def _fetch_index():
+    response = make_get_request("files/index.json")
+    if response.status_code == 200:
+        return response, json.loads(response.content)
+    elif response.status_code == 404:
+        return response, {}
+    return response, None
+
+
+def get_index():
+    return _fetch_index()[1]
+
+
+def _modify_index(model_name, model_metadata):
+    # The file server can only replace index.json as a whole, so always apply
+    # the change to the latest version of it while holding the lock
+    with _index_lock():
+        response, index = _fetch_index()
+        if index is None:
+            # Never overwrite an index that couldn't be read
+            return response
+        index[model_name] = model_metadata
+        response = make_put_request("files/index.json", data=json.dumps(index))
+        if response.status_code in (200, 201):
+            catalogue.index_changed(model_name, model_metadata)
+        return response
+
+
+def update_index(model_name, model_metadata, model_source):
     url_safe_name = urllib.parse.quote(model_name)
     model_metadata["source"] = model_source
     model_metadata["scale"] = 1.0
     model_metadata["url"] = FILESERVER_URL + f"files/models/{url_safe_name}/?zip=true"
-    index[model_name] = model_metadata
-    response = make_put_request("files/index.json", data=json.dumps(index))
-    return response
+    return _modify_index(model_name, model_metadata)
 
 
-def add_blenderkit_model_metadata(folder_name, asset_base_id, index):
-    tags, categories, description = get_blenderkit_metadata(folder_name)
+def add_blenderkit_model_metadata(
+    folder_name, asset_base_id, conversion_key=None, revision=None
+):
+    tags, categories, description, uploaded_revision = get_blenderkit_metadata(
+        folder_name
+    )
     metadata = {
         "tags": tags,
         "categories": categories,
         "description": description,
         "assetBaseId": asset_base_id,
+        # What the uploaded files were converted from, so update models can
+        # tell which ones changed since, see update_models_from_blenderkit_task
+        "blenderkitRevision": revision or uploaded_revision,
+        "exportSettingsKey": get_export_settings_key(),
+        "conversionKey": conversion_key,
     }
     source = "Blenderkit_pro" if len(BLENDERKIT_PRO_API_KEY) > 0 else "Blenderkit"
-    response = update_index(folder_name, metadata, source, index)
+    response = update_index(folder_name, metadata, source)
     return response
@@ -1,17 +1,68 @@
 import requests
-import boto3
-import base64
+import hashlib
 import xmltodict
-import json
 import os
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+from urllib.parse import quote_plus
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.core.cache import cache
+from django.core.files import File
 from django.contrib import messages
-from roboprop_client.tasks import add_blenderkit_model_to_my_models_task
+from roboprop_client.tasks import (
+    add_blenderkit_model_to_my_models_task,
+    add_fuel_model_metadata_task,
+    add_thumbnail_variants_task,
+    suggest_metadata_task,
+    update_models_from_blenderkit_task,
+)
+from celery import chain
 from celery.result import AsyncResult
 import roboprop_client.utils as utils
+import roboprop_client.asset_cache as asset_cache
+import roboprop_client.catalogue as catalogue
+import roboprop_client.chunked_upload as chunked_upload
+from roboprop_client.thumbnails import THUMBNAIL_VARIANTS
+
+THUMBNAIL_FETCH_WORKERS = int(os.getenv("THUMBNAIL_FETCH_WORKERS", 8))
+ASSET_TYPES = ["models", "robots"]
+# Thumbnail URLs are versioned, so browsers may keep them for as long as they like
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", 8))
+
+# Shared between requests, so rendering a gallery doesn't spin up new threads
+_thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_FETCH_WORKERS)
+# External libraries are searched in parallel, so one slow library doesn't
+# hold up the others
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+# For refreshing and prefetching results, kept apart from _search_executor
+# which they wait on
+_background_search_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def _session_cache_key(session_token):
+    # Only a hash of the token is ever stored in the cache
+    digest = hashlib.sha256(session_token.encode("utf-8")).hexdigest()
+    return f"valid_session_{digest}"
+
+
+def _is_valid_session(session_token):
+    cache_key = _session_cache_key(session_token)
+    if cache.get(cache_key):
+        return True
+    response = utils.make_get_request("user/session", session_token)
+    if response.status_code == 200:
+        cache.set(cache_key, True, settings.SESSION_VALIDATION_TTL)
+        return True
+    return False
 
 
 # We use a custom decorator as user login is through DreamFactory, not Django
@@ -19,10 +70,7 @@ def login_required(view_func):
     def _wrapped_view_func(request, *args, **kwargs):
         if "session_token" in request.session:
             # check if session token is valid
-            response = utils.make_get_request(
-                "user/session", request.session["session_token"]
-            )
-            if response.status_code == 200:
+            if _is_valid_session(request.session["session_token"]):
                 return view_func(request, *args, **kwargs)
         # Check if ajax request
         if request.headers.get("x-requested-with") == "XMLHttpRequest":
@@ -49,32 +97,65 @@ def _get_assets(url):
     return assets
 
 
+def _list_assets(asset_type):
+    # Sorted once when the folder is listed, so any page is just a slice
+    assets = asset_cache.get_asset_listing(asset_type)
+    if assets is None:
+        assets = sorted(_get_assets(f"files/{asset_type}/"), key=str.lower)
+        asset_cache.set_asset_listing(asset_type, assets)
+    return assets
+
+
+def _result_or_default(future, default):
+    # Any failure (timeout, bad response...) only affects the asset it belongs to
+    try:
+        return future.result()
+    except Exception:
+        return default
+
+
+def _thumbnail_url(asset, asset_type, index, variant):
+    url = reverse("thumbnail", args=[asset_type, asset, index])
+    # The version changes whenever the asset is uploaded again, which lets
+    # browsers cache the image itself indefinitely.
+    version = asset_cache.get_thumbnail_version(asset_type, asset)
+    return f"{url}?v={version}&variant={variant}"
+
+
 def _get_thumbnails(assets, asset_type, page=1, page_size=12, gallery=True):
     start_index = (page - 1) * page_size
     end_index = start_index + page_size
     assets = assets[start_index:end_index]
+    variant = "gallery" if gallery else "detail"
+
+    # Only the listings are needed to render the page, the images themselves
+    # are loaded lazily by the browser from the thumbnail view.
+    listing_futures = [
+        _thumbnail_executor.submit(utils.list_thumbnails, asset_type, asset)
+        for asset in assets
+    ]
+    listings = [
+        _result_or_default(future, {"paths": [], "variants": []})
+        for future in listing_futures
+    ]
+
     thumbnails = []
-    for asset in assets:
-        url = f"files/{asset_type}/{asset}/thumbnails/"
-        response = utils.make_get_request(url)
-        if response.status_code == 200:
-            thumbnail_data = response.json()["resource"]
-            if gallery:
-                # Just one thumbnail for each in mymodels.html
-                thumbnail_data = thumbnail_data[0:1]
-            for data in thumbnail_data:
-                url = f"files/{data['path']}?is_base64=true"
-                response = utils.make_get_request(url)
-                thumbnail = base64.b64encode(response.content).decode("utf-8")
-                thumbnails.append({"name": asset, "image": thumbnail})
-        else:
+    for asset, listing in zip(assets, listings):
+        paths = listing["paths"]
+        if gallery:
+            # Just one thumbnail for each in mymodels.html
+            paths = paths[0:1]
+        if not paths:
             # Just show a placeholder.
             thumbnails.append({"name": asset, "image": None})
+        for index in range(len(paths)):
+            image = _thumbnail_url(asset, asset_type, index, variant)
+            thumbnails.append({"name": asset, "image": image})
     return thumbnails
 
 
 def _get_all_thumbnails(asset_type, page=1, page_size=12):
-    assets = _get_assets(f"files/{asset_type}/")
+    assets = _list_assets(asset_type)
     if not assets:
         return []
     thumbnails = _get_thumbnails(assets, asset_type, page, page_size)
@@ -96,92 +177,23 @@ def _get_model_configuration(model):
     return model_configuration
 
 
-def _search_external_library(query, library):
-    response = requests.get(query)
-    search_results = (
-        response.json()["results"] if library == "blenderkit" else response.json()
-    )
-    return search_results
+def _fuel_search_url(search, page=1):
+    # Encoded, so e.g "c++" isn't read as "c" and spaces, and "&" can't add
+    # parameters of its own
+    return f"https://fuel.gazebosim.org/1.0/models?q={quote_plus(search)}&page={page}"
 
 
-def _search_and_cache(search):
-    # Check if the results are already cached
-    cache_key = f"search_results_{search}"
-    search_results = cache.get(cache_key)
+def _blenderkit_search_url(search, page=1):
     blenderkit_free = False if len(utils.BLENDERKIT_PRO_API_KEY) > 0 else True
+    return f"https://www.blenderkit.com/api/v1/search/?query=search+text:{quote_plus(search)}+asset_type:model+order:_score+is_free:{blenderkit_free}&page={page}"
 
-    # i.e if there is no cache
-    if not search_results:
-        search_results = {
-            "fuel": _search_external_library(
-                f"https://fuel.gazebosim.org/1.0/models?q={search}", "fuel"
-            ),
-            "blenderkit": _search_external_library(
-                f"https://www.blenderkit.com/api/v1/search/?query=search+text:{search}+asset_type:model+order:_score+is_free:{blenderkit_free}&page=1",
-                "blenderkit",
-            ),
-        }
-        # Cache the results for 5 minutes
-        cache.set(cache_key, search_results, 300)
-
-    return search_results
-
-
-def _remove_outliers_and_sort(items):
-    # Remove single occurences as is most likely an outlier
-    items = [item for item in items if items.count(item) > 1]
-    # Sort by most occurences
-    sorted(items, key=lambda x: items.count(x), reverse=True)
-    # Remove duplicates
-    items = list(set(items))
-    return items
-
-
-def _detect_thumbnail_details(thumbnail):
-    client = boto3.client("rekognition")
-
-    # Confidence can be tweaked, and a lower value does return
-    # more (and sometimes correct) results, but also more noise.
-    response = client.detect_labels(
-        Image={"Bytes": base64.b64decode(thumbnail)},
-        Features=["GENERAL_LABELS", "IMAGE_PROPERTIES"],
-        MinConfidence=90,
-    )
-
-    tags = []
-    categories = []
-    colors = []
-
-    for label in response["Labels"]:
-        tags.append(label["Name"])
-        categories.append(label["Categories"][0]["Name"])
-        if len(label["Parents"]) > 0:
-            # Duplicates handled by _remove_outliers_and_sort()
-            categories.append(label["Parents"][0]["Name"])
 
-        if len(label["Instances"]) > 0:
-            for dominant_color in label["Instances"][0]["DominantColors"]:
-                colors.append(dominant_color["SimplifiedColor"])
+def _parse_fuel_results(data):
+    return data
 
-    return tags, categories, colors
 
-
-def _get_suggested_tags(thumbnails):
-    tags = []
-    categories = []
-    colors = []
-
-    for thumbnail in thumbnails:
-        t, c, col = _detect_thumbnail_details(thumbnail)
-        tags.extend(t)
-        categories.extend(c)
-        colors.extend(col)
-
-    tags = _remove_outliers_and_sort(tags)
-    categories = _remove_outliers_and_sort(categories)
-    colors = _remove_outliers_and_sort(colors)
-
-    return tags, categories, colors
+def _parse_blenderkit_results(data):
+    return data["results"]
 
 
 def _get_blenderkit_model_details(result):
@@ -203,54 +215,165 @@ def _get_fuel_model_details(result):
     }
 
 
-def _add_fuel_model_to_my_models(name, owner):
-    # make a POST Request to our fileserver
-    url = f"files/models/{name}/"
-    parameters = f"?url=https://fuel.gazebosim.org/1.0/{owner}/models/{name}.zip&extract=true&clean=true"
-    response = utils.make_post_request(url, parameters=parameters)
-    return response
+@dataclass(frozen=True)
+class SearchProvider:
+    # Builds the URL for one page of results, from the search term and page
+    search_url: Callable
+    # Seconds to wait for results
+    timeout: float
+    # Picks the list of results out of the JSON response
+    parse_results: Callable
+    # Picks out what find-models.html shows of a single result
+    model_details: Callable
+
+
+# Adding a library here is enough for it to be searched alongside the others
+SEARCH_PROVIDERS = {
+    "fuel": SearchProvider(
+        _fuel_search_url,
+        float(os.getenv("FUEL_SEARCH_TIMEOUT", 5)),
+        _parse_fuel_results,
+        _get_fuel_model_details,
+    ),
+    "blenderkit": SearchProvider(
+        _blenderkit_search_url,
+        float(os.getenv("BLENDERKIT_SEARCH_TIMEOUT", 8)),
+        _parse_blenderkit_results,
+        _get_blenderkit_model_details,
+    ),
+}
+# Search results are shown for SEARCH_FRESH_TIMEOUT, and after that for up to
+# SEARCH_STALE_TIMEOUT while they are refreshed in the background
+SEARCH_FRESH_TIMEOUT = 5 * 60
+SEARCH_STALE_TIMEOUT = 60 * 60
+SEARCH_EMPTY_TIMEOUT = 60
+SEARCH_PARTIAL_TIMEOUT = 30
+SEARCH_LOCK_TIMEOUT = (
+    max(provider.timeout for provider in SEARCH_PROVIDERS.values()) + 5
+)
+SEARCH_POLL_INTERVAL = 0.1
 
 
-def _create_metadata_from_rekognition(name):
-    thumbnails = _get_thumbnails([name], "models", page=1, page_size=1, gallery=False)
-    tags, categories, colors = [], [], []
-    if all(thumbnail["image"] is not None for thumbnail in thumbnails):
-        base64_thumbnails = list(thumbnail["image"] for thumbnail in thumbnails)
-        tags, categories, colors = _get_suggested_tags(base64_thumbnails)
-    return tags, categories, colors
+def _search_external_library(query, library):
+    provider = SEARCH_PROVIDERS[library]
+    response = requests.get(query, timeout=provider.timeout)
+    response.raise_for_status()
+    return provider.parse_results(response.json())
 
 
-def _check_and_get_index(request):
-    response = utils.make_get_request("files/index.json")
-    if response.status_code == 200:
-        # Convert the JSON response to a dictionary
-        index = json.loads(response.content)
-    elif response.status_code == 404:
-        index = {}
+def _search_libraries(search, page=1, libraries=None):
+    """
+    Searches every library at once, returning whatever arrived in time
+    """
+    start = time.monotonic()
+    futures = {}
+    for library in libraries or SEARCH_PROVIDERS:
+        search_url = SEARCH_PROVIDERS[library].search_url(search, page)
+        futures[library] = _search_executor.submit(
+            _search_external_library, search_url, library
+        )
+    search_results = {"unavailable": []}
+    for library, future in futures.items():
+        timeout = SEARCH_PROVIDERS[library].timeout
+        # Every library's deadline counts from the start of the search, so
+        # waiting on one doesn't extend the time given to the next
+        remaining = max(start + timeout - time.monotonic(), 0)
+        try:
+            search_results[library] = future.result(timeout=remaining)
+        except Exception:
+            future.cancel()
+            search_results[library] = []
+            search_results["unavailable"].append(library)
+    return search_results
+
+
+def _normalize_search(search):
+    # "Red Chair", "red  chair" and "RED CHAIR" are all the same search. Query
+    # parameters are already decoded by Django, so "c++" stays as it is.
+    return " ".join(search.casefold().split())
+
+
+def _search_cache_key(search, page=1, libraries=None):
+    # Encoded, so e.g "red chair" and "red+chair" get keys of their own
+    cache_key = "search_results_" + quote_plus(search)
+    # Keys have to stay short enough for every cache backend
+    if len(cache_key) > 200:
+        cache_key = "search_results_" + hashlib.sha1(search.encode()).hexdigest()
+    # Every later page is cached on its own, for each library
+    if page != 1 or libraries:
+        cache_key += f"_{'+'.join(libraries or SEARCH_PROVIDERS)}_{page}"
+    return cache_key
+
+
+def _store_search_results(cache_key, search_results):
+    if search_results["unavailable"]:
+        # Ask the missing library again soon, and keep any complete results
+        # from before around in the meantime
+        fresh_for = SEARCH_PARTIAL_TIMEOUT
+        if cache.get(cache_key) is None:
+            cache.set(cache_key, search_results, SEARCH_STALE_TIMEOUT)
     else:
-        messages.error(request, "Failed to fetch index.json")
-        return redirect("mymodels")
-    return index
+        empty = not any(
+            results
+            for library, results in search_results.items()
+            if library != "unavailable"
+        )
+        fresh_for = SEARCH_EMPTY_TIMEOUT if empty else SEARCH_FRESH_TIMEOUT
+        cache.set(cache_key, search_results, SEARCH_STALE_TIMEOUT)
+    cache.set(f"{cache_key}_fresh", True, fresh_for)
 
 
-def _add_fuel_model_metadata(request, name, description):
-    tags, categories, colors = _create_metadata_from_rekognition(name)
-    metadata = {
-        "tags": tags,
-        "categories": categories,
-        "colors": colors,
-        "description": description,
-    }
-    index = _check_and_get_index(request)
-    response = utils.update_index(name, metadata, "Fuel", index)
+def _refresh_search_results(search, cache_key, page=1, libraries=None):
+    try:
+        search_results = _search_libraries(search, page, libraries)
+        _store_search_results(cache_key, search_results)
+    finally:
+        cache.delete(f"{cache_key}_lock")
+    return search_results
+
+
+def _search_and_cache(search, page=1, libraries=None):
+    search = _normalize_search(search)
+    cache_key = _search_cache_key(search, page, libraries)
+    deadline = time.monotonic() + SEARCH_LOCK_TIMEOUT
+    while True:
+        search_results = cache.get(cache_key)
+        if search_results is not None and cache.get(f"{cache_key}_fresh"):
+            return search_results
+        # Only one request at a time searches the libraries for the same term
+        if cache.add(f"{cache_key}_lock", True, SEARCH_LOCK_TIMEOUT):
+            if search_results is None:
+                return _refresh_search_results(search, cache_key, page, libraries)
+            # Outdated results are still good enough to show straight away
+            _background_search_executor.submit(
+                _refresh_search_results, search, cache_key, page, libraries
+            )
+            return search_results
+        if search_results is not None:
+            return search_results
+        if time.monotonic() > deadline:
+            return _search_libraries(search, page, libraries)
+        # Someone else is already searching, wait for their results
+        time.sleep(SEARCH_POLL_INTERVAL)
+
+
+def _prefetch_next_page(search, page, library):
+    # So "load more" is usually answered from the cache
+    _background_search_executor.submit(_search_and_cache, search, page + 1, [library])
+
+
+def _add_fuel_model_to_my_models(name, owner):
+    # make a POST Request to our fileserver
+    url = f"files/models/{name}/"
+    parameters = f"?url=https://fuel.gazebosim.org/1.0/{owner}/models/{name}.zip&extract=true&clean=true"
+    response = utils.make_post_request(url, parameters=parameters)
+    asset_cache.invalidate_thumbnails("models", name)
+    asset_cache.invalidate_asset_listing("models")
     return response
 
 
 def _get_num_assets(asset_type):
-    assets = _get_assets(f"files/{asset_type}/")
-    if not assets:
-        return 0
-    return len(assets)
+    return len(_list_assets(asset_type))
 
 
 def _login_to_fileserver(username, password):
@@ -272,7 +395,7 @@ def _login_to_fileserver(username, password):
         return None
 
 
-def _handle_fuel_library(request, name, index):
+def _handle_fuel_library(request, name):
     owner = request.POST.get("owner")
     description = request.POST.get("description")
     response = _add_fuel_model_to_my_models(name, owner)
@@ -280,29 +403,27 @@ def _handle_fuel_library(request, name, index):
         return JsonResponse(
             {"error": f"Model: {name} failed to upload"}, status=response.status_code
         )
-
-    metadata_response = _add_fuel_model_metadata(request, name, description)
-    if metadata_response.status_code != 201:
-        return JsonResponse(
-            {"error": f"Model: {name} uploaded, but failed to tag"},
-            status=metadata_response.status_code,
-        )
-
+    # Tagged from the resized thumbnails, so those are made first
+    task = chain(
+        add_thumbnail_variants_task.si("models", name),
+        add_fuel_model_metadata_task.si(name, description),
+    ).delay()
     return JsonResponse(
         {
-            "message": f"Success: Model: {name} added to My Models, and successfully tagged"
+            "task_id": task.id,
+            "message": f"Model: {name} added to My Models, tagging in progress...",
         },
-        status=metadata_response.status_code,
+        status=202,
     )
 
 
-def _handle_blenderkit_library(request, name, index):
+def _handle_blenderkit_library(request, name):
     thumbnail = request.POST.get("thumbnail")
     asset_base_id = request.POST.get("assetBaseId")
     folder_name = utils.capitalize_and_remove_spaces(name)
     try:
         task = add_blenderkit_model_to_my_models_task.delay(
-            folder_name, asset_base_id, thumbnail, index
+            folder_name, asset_base_id, thumbnail
         )
         return JsonResponse(
             {"task_id": task.id, "message": "Blender to sdf conversion in progress..."},
@@ -312,6 +433,30 @@ def _handle_blenderkit_library(request, name, index):
         return JsonResponse({"error": str(e)}, status=500)
 
 
+def _handle_upload(request, file, asset_type):
+    response = utils.upload_file(file, asset_type)
+    asset_name = os.path.splitext(file.name)[0]
+    if response.status_code != 201:
+        if asset_type == "robots":
+            messages.error(request, "Failed to upload Robot")
+            return False, redirect("myrobots")
+        messages.error(request, "Failed to upload model")
+        return False, redirect("mymodels")
+
+    if asset_type == "robots":
+        add_thumbnail_variants_task.delay(asset_type, asset_name)
+        messages.success(request, "Robot uploaded successfully")
+        return True, redirect("myrobots")
+    messages.success(request, "Model uploaded successfully")
+    # Tagged from the resized thumbnails, so those are made first
+    task = chain(
+        add_thumbnail_variants_task.si(asset_type, asset_name),
+        suggest_metadata_task.si(asset_type, asset_name),
+    ).delay()
+    request.session["model_meta_data"] = {"name": asset_name, "task_id": task.id}
+    return True, redirect("add_metadata", name=asset_name)
+
+
 """VIEWS"""
 
 
@@ -340,6 +485,7 @@ def login(request):
 @login_required
 def logout(request):
     url = "system/admin/session" if request.session["admin"] == True else "user/session"
+    cache.delete(_session_cache_key(request.session["session_token"]))
     response = utils.make_delete_request(url, request.session["session_token"])
     if response.status_code == 200:
         del request.session["admin"]
@@ -356,22 +502,8 @@ def mymodels(request):
     page = int(request.GET.get("page", 1))
     page_size = int(request.GET.get("page_size", 12))
     if request.method == "POST":
-        file = request.FILES["file"]
-        response = utils.upload_file(file, "models")
-        if response.status_code == 201:
-            messages.success(request, "Model uploaded successfully")
-            model_name = os.path.splitext(file.name)[0]
-            tags, categories, colors = _create_metadata_from_rekognition(model_name)
-            request.session["model_meta_data"] = {
-                "name": model_name,
-                "tags": tags,
-                "categories": categories,
-                "colors": colors,
-            }
-            return redirect("add_metadata", name=model_name)
-        else:
-            messages.error(request, "Failed to upload model")
-            return redirect("mymodels")
+        _, response = _handle_upload(request, request.FILES["file"], "models")
+        return response
 
     total_num_models = _get_num_assets("models")
     total_pages = math.ceil(total_num_models / page_size)
@@ -411,35 +543,65 @@ def find_models(request):
     # Check if there is a search query via GET
     search = request.GET.get("search", "")
     blenderkit_id = request.GET.get("add-directly", "")
-    fuel_models = []
-    blenderkit_models = []
+    models = {library: [] for library in SEARCH_PROVIDERS}
+    unavailable = []
 
     if search:
         search_results = _search_and_cache(search)
-
-        for result in search_results["fuel"]:
-            fuel_model_details = _get_fuel_model_details(result)
-            fuel_models.append(fuel_model_details)
-
-        for result in search_results["blenderkit"]:
-            blenderkit_model_details = _get_blenderkit_model_details(result)
-            blenderkit_models.append(blenderkit_model_details)
+        unavailable = search_results["unavailable"]
+        for library, provider in SEARCH_PROVIDERS.items():
+            results = search_results.get(library, [])
+            if results:
+                _prefetch_next_page(search, 1, library)
+            models[library] = [provider.model_details(result) for result in results]
     elif blenderkit_id:
         result = requests.get(
             f"https://www.blenderkit.com/api/v1/search/?query=asset_base_id:{blenderkit_id}"
         )
         data = result.json()["results"][0]
         blenderkit_model_details = _get_blenderkit_model_details(data)
-        blenderkit_models.append(blenderkit_model_details)
+        models["blenderkit"].append(blenderkit_model_details)
 
-    context = {
-        "search": search,
-        "fuel_models": fuel_models,
-        "blenderkit_models": blenderkit_models,
-    }
+    context = {"search": search, "unavailable": unavailable}
+    for library, library_models in models.items():
+        context[f"{library}_models"] = library_models
+        # The first page came with the search, "load more" continues from here
+        context[f"{library}_next_page"] = 2 if search and library_models else None
     return render(request, "find-models.html", context=context)
 
 
+@login_required
+def find_models_page(request):
+    """
+    Returns one more page of results from one library, e.g.
+    ?search=chair&library=fuel&page=2
+    """
+    search = request.GET.get("search", "")
+    library = request.GET.get("library")
+    if not search or library not in SEARCH_PROVIDERS:
+        return JsonResponse({"error": "Invalid search or library"}, status=400)
+    try:
+        page = max(int(request.GET.get("page", 2)), 1)
+    except ValueError:
+        return JsonResponse({"error": "Invalid page"}, status=400)
+
+    search_results = _search_and_cache(search, page, [library])
+    model_details = SEARCH_PROVIDERS[library].model_details
+    models = [model_details(result) for result in search_results[library]]
+    unavailable = library in search_results["unavailable"]
+    if unavailable:
+        # Let the user try the same page again
+        next_page = page
+    elif models:
+        next_page = page + 1
+        _prefetch_next_page(search, page, library)
+    else:
+        next_page = None
+    return JsonResponse(
+        {"models": models, "next_page": next_page, "unavailable": unavailable}
+    )
+
+
 @login_required
 def add_to_my_models(request):
     """
@@ -450,11 +612,10 @@ def add_to_my_models(request):
 
     name = request.POST.get("name")
     library = request.POST.get("library")
-    index = _check_and_get_index(request)
     if library == "fuel":
-        return _handle_fuel_library(request, name, index)
+        return _handle_fuel_library(request, name)
     elif library == "blenderkit":
-        return _handle_blenderkit_library(request, name, index)
+        return _handle_blenderkit_library(request, name)
     else:
         return JsonResponse(
             {
@@ -466,12 +627,8 @@ def add_to_my_models(request):
 @login_required
 def myrobots(request):
     if request.method == "POST":
-        response = utils.upload_file(request.FILES["file"], "robots")
-        if response.status_code == 201:
-            messages.success(request, "Robot uploaded successfully")
-        else:
-            messages.error(request, "Failed to upload Robot")
-        return redirect("myrobots")
+        _, response = _handle_upload(request, request.FILES["file"], "robots")
+        return response
     gallery_thumbnails = _get_all_thumbnails("robots")
     return render(request, "myrobots.html", {"thumbnails": gallery_thumbnails})
 
@@ -517,8 +674,17 @@ def add_metadata(request, name):
             "categories": categories,
             "colors": colors,
         }
-        index = _check_and_get_index(request)
-        response = utils.update_index(name, metadata, "Upload", index)
+        try:
+            response = utils.update_index(name, metadata, "Upload")
+        except TimeoutError:
+            # Someone else is updating index.json, the form can be sent again
+            messages.error(request, "Models are being updated, please try again")
+            return render(
+                request,
+                "add_metadata.html",
+                {"name": name, "meta_data": metadata},
+                status=503,
+            )
         if response.status_code == 201:
             messages.success(request, "Model tagged successfully")
         else:
@@ -530,10 +696,19 @@ def add_metadata(request, name):
     # not be accessible unless the user has just uploaded a model.
     model_meta_data = request.session.get("model_meta_data")
     if model_meta_data:
+        task = AsyncResult(model_meta_data["task_id"])
+        if not task.ready():
+            # The page reloads itself once the suggestions are in
+            return render(
+                request,
+                "add_metadata.html",
+                {"name": name, "meta_data": {}, "task_id": task.id},
+            )
+        suggestions = task.result if task.successful() else {}
         meta_data = {
-            "tags": model_meta_data.get("tags"),
-            "categories": model_meta_data.get("categories"),
-            "colors": model_meta_data.get("colors"),
+            "tags": suggestions.get("tags", []),
+            "categories": suggestions.get("categories", []),
+            "colors": suggestions.get("colors", []),
         }
         del request.session["model_meta_data"]
         return render(
@@ -547,52 +722,145 @@ def add_metadata(request, name):
 @login_required
 def update_models_from_blenderkit(request):
     if request.method == "POST":
-        # get index.json
-        index = _check_and_get_index(request)
-        task_ids = []
-        for model in index:
-            # check if model has key assetBaseId, i.e is from blenderkit
-            if "assetBaseId" in index[model]:
-                asset_base_id = index[model]["assetBaseId"]
-                folder_name = model
-                # Get the thumbnail from blenderkit, in case saved ones are lost
-                result = requests.get(
-                    f"https://www.blenderkit.com/api/v1/search/?query=asset_base_id:{asset_base_id}"
-                )
-                data = result.json()["results"][0]
-                thumbnail = data["thumbnailMiddleUrl"]
-                try:
-                    task = add_blenderkit_model_to_my_models_task.delay(
-                        folder_name, asset_base_id, thumbnail, index
-                    )
-                    task_ids.append(task.id)
-                except ValueError as e:
-                    return JsonResponse({"error": str(e)}, status=500)
+        # Checking which models changed takes a lookup per model, so it runs
+        # in the background too, see task_status for the summary
+        task = update_models_from_blenderkit_task.delay()
         return JsonResponse(
             {
-                "task_ids": task_ids,
-                "message": "Blender to sdf conversion in progress...",
+                "task_id": task.id,
+                "message": "Checking Blenderkit models for updates...",
             },
             status=202,
         )
-
-        # # reupload index.json
-        # response = utils.make_put_request("files/index.json", data=json.dumps(index))
-        # if response.status_code == 201:
-        #     return JsonResponse(
-        #         {"message": f"Success: All models from blenderkit updated"}, status=201
-        #     )
-        # else:
-        #     return JsonResponse(
-        #         {"error": f"Models updated, but index.json failed to reupload"},
-        #         status=500,
-        #     )
     else:
         return JsonResponse({"error": "Invalid request method"}, status=405)
 
 
+@login_required
+def create_upload(request):
+    """
+    Starts a resumable upload, see chunked_upload.py
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    asset_type = request.POST.get("asset_type")
+    filename = request.POST.get("filename")
+    try:
+        size = int(request.POST.get("size"))
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "Invalid file size"}, status=400)
+    if asset_type not in ASSET_TYPES or not filename or size < 0:
+        return JsonResponse({"error": "Invalid upload"}, status=400)
+    upload = chunked_upload.create_upload(asset_type, filename, size)
+    return JsonResponse(upload, status=201)
+
+
+@login_required
+def upload_chunk(request, upload_id):
+    try:
+        if request.method == "GET":
+            # Lets the client find out where to resume from
+            return JsonResponse(chunked_upload.get_upload(upload_id))
+        elif request.method == "PUT":
+            offset = int(request.headers.get("Upload-Offset", -1))
+            # Read straight from the request, so the chunk is never all in memory
+            offset = chunked_upload.write_chunk(upload_id, offset, request)
+            return JsonResponse({"offset": offset})
+        else:
+            return JsonResponse({"error": "Invalid request method"}, status=405)
+    except FileNotFoundError as e:
+        return JsonResponse({"error": str(e)}, status=404)
+    except chunked_upload.UploadOffsetError as e:
+        return JsonResponse({"error": str(e), "offset": e.offset}, status=409)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+
+@login_required
+def finalize_upload(request, upload_id):
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    try:
+        upload, path = chunked_upload.get_completed_file(upload_id)
+    except FileNotFoundError as e:
+        return JsonResponse({"error": str(e)}, status=404)
+    except chunked_upload.UploadOffsetError as e:
+        return JsonResponse({"error": str(e), "offset": e.offset}, status=409)
+
+    with open(path, "rb") as upload_file:
+        file = File(upload_file, name=upload["filename"])
+        success, response = _handle_upload(request, file, upload["asset_type"])
+    # If sending it on failed, keep the upload so finalizing can be retried
+    if success:
+        chunked_upload.delete_upload(upload_id)
+    return JsonResponse({"redirect": response.url}, status=201 if success else 502)
+
+
+@login_required
+def search_catalogue(request):
+    """
+    Searches our own models, e.g. ?q=red chair&category=furniture&source=Fuel
+    """
+    filters = {}
+    for facet in catalogue.FACETS:
+        values = request.GET.getlist(facet)
+        if values:
+            filters[facet] = values
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+        page_size = min(max(int(request.GET.get("page_size", 20)), 1), 100)
+    except ValueError:
+        return JsonResponse({"error": "Invalid page"}, status=400)
+    try:
+        results = catalogue.search(
+            utils.get_index,
+            request.GET.get("q", ""),
+            filters,
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=502)
+    results["page"] = page
+    results["page_size"] = page_size
+    return JsonResponse(results)
+
+
+@login_required
+def thumbnail(request, asset_type, name, index):
+    if asset_type not in ASSET_TYPES:
+        raise Http404(f"Unknown asset type: {asset_type}")
+    variant = request.GET.get("variant")
+    if variant not in THUMBNAIL_VARIANTS:
+        variant = None
+    listing = utils.list_thumbnails(asset_type, name)
+    if index >= len(listing["paths"]):
+        raise Http404(f"{name} has no thumbnail {index}")
+    image = utils.download_thumbnail_variant(asset_type, name, listing, index, variant)
+    if image is None:
+        raise Http404(f"Failed to fetch thumbnail {index} of {name}")
+
+    response = HttpResponse(image["content"], content_type=image["content_type"])
+    response.headers["ETag"] = quote_etag(image["etag"])
+    if image["last_modified"]:
+        response.headers["Last-Modified"] = http_date(image["last_modified"])
+    # Thumbnails are only visible to logged in users, so keep them out of shared caches
+    patch_cache_control(response, private=True, max_age=THUMBNAIL_MAX_AGE)
+    # Returns a 304 instead if the browser's copy is still current
+    return get_conditional_response(
+        request,
+        etag=response.headers["ETag"],
+        last_modified=image["last_modified"],
+        response=response,
+    )
+
+
 @login_required
 def task_status(request, task_id):
     task = AsyncResult(task_id)
     response_data = {"status": task.status}
+    if task.status == "PROGRESS":
+        response_data["progress"] = task.info
+    elif task.status == "SUCCESS":
+        response_data["result"] = task.result
     return JsonResponse(response_data)